@@ -0,0 +1,223 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import huffman
+from huffman import HuffmanTree
+
+# Benchmarks for HuffmanTree tree building, encoding and decoding.
+#
+#   python bench_huffman.py                 # table on stdout
+#   python bench_huffman.py --json          # one JSON object per line
+#   python bench_huffman.py --quick --json --output bench_output.txt
+#
+# Every workload is a generated message over an alphabet of byte characters
+# (chr(0)..chr(255)) with uniform, Zipfian or highly skewed weights, plus the
+# cases in testcases_huffman.txt. Each engine is timed best-of --repeat, then
+# run once more under tracemalloc for its peak memory, so the tracing
+# doesn't skew the timings.
+
+
+def uniform_weights(alphabet_size):
+    return [1] * alphabet_size
+
+def zipf_weights(alphabet_size, exponent=1.1):
+    return [1.0 / (rank + 1) ** exponent for rank in range(alphabet_size)]
+
+def skewed_weights(alphabet_size):
+    # Fibonacci-like: every symbol about as likely as all rarer ones together,
+    # which gives the deepest possible tree
+    weights = [1, 1]
+    while len(weights) < alphabet_size:
+        weights.append(weights[-1] + weights[-2])
+    return weights[:alphabet_size]
+
+DISTRIBUTIONS = {
+    'uniform': uniform_weights,
+    'zipf': zipf_weights,
+    'skewed': skewed_weights,
+}
+
+def make_message(distribution, alphabet_size, length, rng):
+    weights = DISTRIBUTIONS[distribution](alphabet_size)
+    symbols = [chr(i) for i in range(alphabet_size)]
+    message = ''.join(rng.choices(symbols, weights=weights, k=length))
+    # every symbol gets a weight of at least one, so the tree covers the alphabet
+    counts = huffman.count_symbols(message)
+    symbol_list = [(symbol, counts[symbol] + 1) for symbol in symbols]
+    return symbol_list, message
+
+
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def engines(tree, message):
+    # (name, encode, decode) for every engine that applies to this workload
+    payload = message.encode('latin-1')
+    found = [
+        ('string', lambda: tree.encode(message), tree.decode),
+        ('bytes', lambda: tree.encode_bytes(message), tree.decode_bytes),
+    ]
+    if huffman.np is not None:
+        found.append(('numpy', lambda: tree.encode_array(payload), tree.decode_array))
+    return found
+
+
+def bench_message(workload, symbol_list, message, repeat):
+    results = []
+
+    for build_engine in ('heap', 'two_queue'):
+        build_time, tree = best_time(lambda: HuffmanTree(symbol_list, build_engine=build_engine), repeat)
+        results.append({
+            'workload': workload,
+            'engine': 'build_' + build_engine,
+            'phase': 'build',
+            'alphabet': len(symbol_list),
+            'seconds': build_time,
+            'peak_bytes': peak_memory(lambda: HuffmanTree(symbol_list, build_engine=build_engine)),
+        })
+
+    tree = HuffmanTree(symbol_list)
+    size = len(message)
+
+    for name, encode, decode in engines(tree, message):
+        # table building happens once per tree, keep it out of the timings.
+        # decode only builds its k-bit table once enough bits have gone
+        # through bit by bit, so one warm-up decode may not, build it here
+        tree._get_decode_table(tree.decode_bits)
+        tree._get_decode_table(8)
+        encoded = encode()
+        decode(encoded)
+
+        encode_time, encoded = best_time(encode, repeat)
+        decode_time, _ = best_time(lambda: decode(encoded), repeat)
+
+        for phase, seconds, func in (('encode', encode_time, encode), ('decode', decode_time, lambda: decode(encoded))):
+            results.append({
+                'workload': workload,
+                'engine': name,
+                'phase': phase,
+                'alphabet': len(symbol_list),
+                'symbols': size,
+                'seconds': seconds,
+                'mb_per_s': size / seconds / 1e6 if seconds else None,
+                'ns_per_symbol': seconds / size * 1e9 if size else None,
+                'peak_bytes': peak_memory(func),
+            })
+
+    return results
+
+def bench_testcases(path, repeat):
+    cases = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.strip().split(";")
+            symbols = fields[1].split(",")
+            weights = [int(w) for w in fields[2].split(",")]
+            cases.append((list(zip(symbols, weights)), fields[4], fields[6]))
+
+    def build():
+        for symbol_list, _, _ in cases:
+            HuffmanTree(symbol_list)
+
+    # trees aren't kept between cases, since every one caches its own
+    # decode tables, the same way test_huffman.py runs them
+    def run():
+        for symbol_list, encode_input, decode_input in cases:
+            tree = HuffmanTree(symbol_list)
+            tree.decode(tree.encode(encode_input))
+            tree.decode(decode_input)
+
+    build_time, _ = best_time(build, repeat)
+    run_time, _ = best_time(run, repeat)
+
+    return [
+        {'workload': 'testcases', 'engine': 'build_heap', 'phase': 'build', 'cases': len(cases),
+         'seconds': build_time, 'peak_bytes': peak_memory(build)},
+        {'workload': 'testcases', 'engine': 'string', 'phase': 'build+encode+decode', 'cases': len(cases),
+         'seconds': run_time, 'peak_bytes': peak_memory(run)},
+    ]
+
+
+def print_table(results, out):
+    print("%-24s %-16s %-20s %10s %10s %12s %12s" % (
+        'workload', 'engine', 'phase', 'seconds', 'MB/s', 'ns/symbol', 'peak KiB'), file=out)
+    for r in results:
+        mb_per_s = r.get('mb_per_s')
+        ns_per_symbol = r.get('ns_per_symbol')
+        print("%-24s %-16s %-20s %10.4f %10s %12s %12d" % (
+            r['workload'], r['engine'], r['phase'], r['seconds'],
+            '-' if mb_per_s is None else '%.2f' % mb_per_s,
+            '-' if ns_per_symbol is None else '%.1f' % ns_per_symbol,
+            r['peak_bytes'] // 1024), file=out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark HuffmanTree build, encode and decode.")
+    parser.add_argument('--json', action='store_true', help="write one JSON object per result")
+    parser.add_argument('--output', help="write results here instead of stdout")
+    parser.add_argument('--quick', action='store_true', help="small sizes, for a smoke run")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per measurement, best is kept")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--testcases', default='testcases_huffman.txt',
+                        help="testcase file to include, or '' to skip it")
+    args = parser.parse_args(argv)
+
+    alphabet_sizes = [2, 26, 256]
+    lengths = [10000] if args.quick else [100000, 1000000]
+
+    rng = random.Random(args.seed)
+    results = []
+
+    for distribution in DISTRIBUTIONS:
+        for alphabet_size in alphabet_sizes:
+            for length in lengths:
+                symbol_list, message = make_message(distribution, alphabet_size, length, rng)
+                workload = '%s/a%d/n%d' % (distribution, alphabet_size, length)
+                results.extend(bench_message(workload, symbol_list, message, args.repeat))
+
+    if args.testcases:
+        results.extend(bench_testcases(args.testcases, args.repeat))
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if args.json:
+            meta = {
+                'python': platform.python_version(),
+                'numpy': None if huffman.np is None else huffman.np.__version__,
+                'seed': args.seed,
+                'repeat': args.repeat,
+            }
+            for r in results:
+                r.update(meta)
+                print(json.dumps(r, sort_keys=True), file=out)
+        else:
+            print_table(results, out)
+    finally:
+        if args.output:
+            out.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,17 @@
 # to get the element that appears the majority of the time in the list:
 #
 
+import collections
+import math
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+  import numpy as np
+except ImportError:  # numpy is optional, only used by add_many on arrays
+  np = None
+
 class BoyerMooreMajority:
   def __init__(self):
     self.guess = None
@@ -25,6 +36,72 @@ class BoyerMooreMajority:
     else:  # decreased if not matched
       self.counter -= 1
 
+  # Registers every element of `elements` in order, with the same result as
+  # calling `add_next_element` on each. The state is kept in local variables
+  # for the whole batch. Integer numpy arrays are run length encoded first
+  # and taken a run at a time, which only pays off for run heavy input (long
+  # stretches of equal values); arrays with more runs than half their length
+  # are converted to a list and go element by element. Returns self.
+  def add_many(self, elements):
+    if np is not None and isinstance(elements, np.ndarray) and elements.dtype.kind in 'biu':
+      return self._add_runs(elements.ravel())
+
+    guess = self.guess
+    counter = self.counter
+
+    for element in elements:
+      assert(element is not None)
+      if counter == 0:
+        guess = element
+      if element == guess:
+        counter += 1
+      else:
+        counter -= 1
+
+    self.guess = guess
+    self.counter = counter
+    return self
+
+  # A run of `run` equal elements `value` changes the state in one step:
+  # matching the guess (or starting from 0) adds the run; otherwise the run
+  # cancels up to `counter` votes, and whatever is left of it after reaching
+  # 0 makes `value` the guess with the remainder as its counter.
+  def _add_runs(self, values):
+    if len(values) == 0:
+      return self
+
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    # short runs cost more a run than the plain loop does an element
+    if len(starts) * 2 > len(values):
+      return self.add_many(values.tolist())
+    runs = np.diff(np.append(starts, len(values)))
+
+    guess = self.guess
+    counter = self.counter
+
+    for value, run in zip(values[starts].tolist(), runs.tolist()):
+      if counter == 0:
+        guess = value
+        counter = run
+      elif value == guess:
+        counter += run
+      elif run < counter:
+        counter -= run
+      elif run == counter:
+        counter = 0
+      else:
+        guess = value
+        counter = run - counter
+
+    self.guess = guess
+    self.counter = counter
+    return self
+
+  # Builds an instance that has seen every element of `elements`.
+  @classmethod
+  def from_iterable(cls, elements):
+    return cls().add_many(elements)
+
   # Gives the best guess of which of the elements seen so far make up the
   # majority of the elements in set of elements. If a majority element exists,
   # this algorithm will report it correctly. Otherwise, there is no guarantee
@@ -32,6 +109,317 @@ class BoyerMooreMajority:
   def get_majority(self):
     return self.guess  # return the current guess
 
+  # Folds in the summary of another instance that saw a different part of
+  # the stream, e.g. another shard. Matching guesses add their counters;
+  # otherwise the larger counter cancels against the smaller, just as the
+  # elements behind them would have. A majority element of the whole stream
+  # is still guaranteed to be the guess afterwards, though the counter may
+  # differ from feeding the elements through one instance. Returns self, so
+  # merges can be chained or used with functools.reduce.
+  def merge(self, other):
+    if other.counter == 0:
+      return self
+
+    if self.counter == 0:
+      self.guess = other.guess
+      self.counter = other.counter
+    elif other.guess == self.guess:
+      self.counter += other.counter
+    elif other.counter > self.counter:
+      self.guess = other.guess
+      self.counter = other.counter - self.counter
+    else:
+      self.counter -= other.counter
+
+    return self
+
+
+# Misra-Gries summary: finds every element making up more than 1/k of a
+# stream in one pass, keeping at most k - 1 candidate counters. Each
+# counter undercounts its element's true weight by at most total / k, and
+# anything heavier than total / k is guaranteed to be a candidate. Elements
+# may come with integer weights. With k=2 this is exactly
+# BoyerMooreMajority: `guess` and `counter` come out the same after any
+# sequence of elements, weighted or not, and after merges.
+class MisraGries:
+  def __init__(self, k=2):
+    assert(k >= 2)
+    self.k = k
+    self.counters = {}  # candidate -> counter, at most k - 1 of them
+    self.total = 0  # total weight seen
+    self._last = None  # guess to report once every counter has run out
+
+  # Registers `element` with `weight`, as if it had appeared `weight` times
+  # in a row. If there's no room for a new candidate, the weight cancels
+  # against every counter at once, as far as the smallest counter goes; any
+  # weight left over then has a free slot.
+  def add_next_element(self, element, weight=1):
+    assert(element is not None)
+    assert(weight >= 1)
+
+    self.total += weight
+    counters = self.counters
+
+    if element in counters:
+      counters[element] += weight
+      return
+
+    if len(counters) == self.k - 1:
+      cut = min(weight, min(counters.values()))
+      for candidate in list(counters):
+        counters[candidate] -= cut
+        if counters[candidate] == 0:
+          del counters[candidate]
+      weight -= cut
+
+    if weight > 0:
+      counters[element] = weight
+      self._last = element
+
+  # Registers every element of `elements` with weight 1. Returns self.
+  def add_many(self, elements):
+    add = self.add_next_element
+    for element in elements:
+      add(element)
+    return self
+
+  # The candidate with the largest counter, like BoyerMooreMajority's guess.
+  @property
+  def guess(self):
+    if len(self.counters) == 0:
+      return self._last
+    return max(self.counters, key=self.counters.get)
+
+  @property
+  def counter(self):
+    return max(self.counters.values(), default=0)
+
+  # Candidates for the elements above total / k, with their counters, the
+  # largest first. Can include elements that aren't that frequent; `verify`
+  # weeds those out.
+  def heavy_hitters(self):
+    return sorted(self.counters.items(), key=lambda item: item[1], reverse=True)
+
+  # Folds in the summary of another instance with the same k that saw a
+  # different part of the stream: counters are added, then the k-th largest
+  # is taken off all of them so at most k - 1 stay positive. Returns self.
+  def merge(self, other):
+    assert(other.k == self.k)
+
+    if self.counter > 0:
+      last = self.guess
+    elif other.counter > 0:
+      last = other.guess
+    else:
+      last = self._last
+
+    counters = self.counters
+    for candidate, count in other.counters.items():
+      counters[candidate] = counters.get(candidate, 0) + count
+    self.total += other.total
+
+    if len(counters) >= self.k:
+      cut = sorted(counters.values(), reverse=True)[self.k - 1]
+      for candidate in list(counters):
+        counters[candidate] -= cut
+        if counters[candidate] <= 0:
+          del counters[candidate]
+
+    self._last = last
+    return self
+
+  # Second pass over the same stream: counts the candidates exactly and
+  # returns {element: count} for those really above total / k. With
+  # `weighted=True` the stream is `(element, weight)` pairs.
+  def verify(self, elements, weighted=False):
+    counts = dict.fromkeys(self.counters, 0)
+    total = 0
+
+    for element in elements:
+      weight = 1
+      if weighted:
+        element, weight = element
+      total += weight
+      if element in counts:
+        counts[element] += weight
+
+    return {element: count for element, count in counts.items() if count * self.k > total}
+
+
+# Exact majority of the last `size` elements of a stream. The window is a
+# deque with a count per distinct element in it, O(size) memory. Each update
+# is O(1): the window's majority can only become the element just added
+# (every other count stays or drops, and the window never shrinks), so only
+# that element and the current majority need checking. `get_majority`
+# returns None when no element has more than half of the window.
+class WindowedMajority:
+  def __init__(self, size):
+    assert(size >= 1)
+    self.size = size
+    self.window = collections.deque()
+    self.counts = {}
+    self.majority = None
+
+  def add_next_element(self, element):
+    assert(element is not None)
+
+    window = self.window
+    counts = self.counts
+
+    window.append(element)
+    counts[element] = counts.get(element, 0) + 1
+
+    # slide past the oldest element once the window is full
+    if len(window) > self.size:
+      oldest = window.popleft()
+      counts[oldest] -= 1
+      if counts[oldest] == 0:
+        del counts[oldest]
+
+    if counts[element] * 2 > len(window):
+      self.majority = element
+    elif self.majority is not None and counts.get(self.majority, 0) * 2 <= len(window):
+      self.majority = None
+
+  def get_majority(self):
+    return self.majority
+
+
+# Boyer-Moore with exponentially decaying votes, so the guess follows the
+# recent stream rather than its whole history. The counter loses half its
+# weight every `half_life`: counted in elements, or in the units of the
+# timestamps if `add_next_element` is given them (e.g. time.monotonic()).
+# A new element then votes with weight 1 under the weighted rule of
+# MisraGries(2): for or against the guess, taking over the guess if it
+# outweighs the counter. O(1) time and memory per update.
+class DecayedMajority:
+  def __init__(self, half_life):
+    assert(half_life > 0)
+    self.half_life = half_life
+    self.guess = None
+    self.counter = 0.0
+    self.last_time = None  # timestamp of the previous element, if given
+
+  def add_next_element(self, element, timestamp=None):
+    assert(element is not None)
+
+    if timestamp is None:
+      elapsed = 1
+    else:
+      elapsed = 0 if self.last_time is None else max(timestamp - self.last_time, 0)
+      self.last_time = timestamp
+    self.counter *= math.pow(0.5, elapsed / self.half_life)
+
+    if self.counter == 0 or element == self.guess:
+      if self.counter == 0:
+        self.guess = element
+      self.counter += 1
+    elif self.counter > 1:
+      self.counter -= 1
+    elif self.counter == 1:
+      self.counter = 0.0
+    else:
+      self.guess = element
+      self.counter = 1 - self.counter
+
+  def get_majority(self):
+    return self.guess
+
+
+# Runs one shard through a fresh instance. Lives at module level so process
+# pool workers can import it.
+def _shard_majority(shard):
+  return BoyerMooreMajority.from_iterable(shard)
+
+# Finds the majority guess over a stream split into `shards` (iterables that
+# can be pickled, like lists), running each shard in a process pool and
+# merging the summaries pairwise, level by level, like a reduction tree.
+# Returns the merged BoyerMooreMajority.
+def parallel_majority(shards, max_workers=None):
+  with ProcessPoolExecutor(max_workers) as pool:
+    summaries = list(pool.map(_shard_majority, shards))
+
+  if len(summaries) == 0:
+    return BoyerMooreMajority()
+
+  while len(summaries) > 1:
+    merged = [summaries[i].merge(summaries[i + 1]) for i in range(0, len(summaries) - 1, 2)]
+    if len(summaries) % 2:
+      merged.append(summaries[-1])
+    summaries = merged
+
+  return summaries[0]
+
+
+# Majority element of `source`, checked: a Boyer-Moore pass finds the
+# guess, then a second pass counts it, and the result is None unless it
+# really makes up more than half of the elements. Memory stays constant
+# since `source` is streamed twice instead of held. `source` may be:
+#   - a file path, whose bytes are the elements (ints 0-255), read through
+#     a memory map
+#   - a bytes-like buffer, such as an mmap, with the same byte elements
+#   - a callable returning a fresh iterable of the elements on every call
+#   - any other iterable that can be iterated twice, like a list
+# Buffers go through `chunk_size` bytes at a time.
+def verified_majority(source, chunk_size=1 << 20):
+  assert(chunk_size >= 1)
+
+  if isinstance(source, (str, os.PathLike)):
+    with open(source, 'rb') as f:
+      # empty files can't be mapped
+      if os.fstat(f.fileno()).st_size == 0:
+        return None
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _verified_buffer_majority(data, chunk_size)
+
+  if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+    return _verified_buffer_majority(source, chunk_size)
+
+  if callable(source):
+    elements = source
+  elif iter(source) is source:
+    raise TypeError("an iterator can only be read once; pass a function returning a fresh one")
+  else:
+    elements = lambda: source
+
+  bmm = BoyerMooreMajority.from_iterable(elements())
+  if bmm.counter == 0:
+    return None
+
+  guess = bmm.guess
+  total = 0
+  matches = 0
+  for element in elements():
+    total += 1
+    if element == guess:
+      matches += 1
+
+  return guess if matches * 2 > total else None
+
+def _verified_buffer_majority(data, chunk_size):
+  with memoryview(data) as buffer:
+    view = buffer.cast('B')
+
+    bmm = BoyerMooreMajority()
+    for i in range(0, len(view), chunk_size):
+      chunk = view[i:i + chunk_size]
+      bmm.add_many(chunk if np is None else np.frombuffer(chunk, dtype=np.uint8))
+    chunk = None  # drop the last reference into the buffer
+
+    if bmm.counter == 0:
+      return None
+
+    # bytes.count does the counting, a chunk at a time
+    needle = bytes([bmm.guess])
+    matches = 0
+    for i in range(0, len(view), chunk_size):
+      matches += bytes(view[i:i + chunk_size]).count(needle)
+
+    total = len(view)
+    view.release()
+
+  return bmm.guess if matches * 2 > total else None
+
 
 # l = [2, 2, 2, 4, 5, 5, 2, 2, 3]
 
@@ -1,4 +1,23 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import hashlib
 import heapq
+import math
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only used for fast paths
+    np = None
 
 # Represents a Huffman tree for use in encoding/decoding strings.
 # A sample usage is as follows:
@@ -8,29 +27,392 @@ import heapq
 # assert(h.decode(h.encode('ABC')) == 'ABC')
 
 def BinaryTreeToString(root):
-    if root.symbol is not None: return root.symbol
-    else: return "(%s%s)"%(BinaryTreeToString(root.left), BinaryTreeToString(root.right))
+    # explicit stack rather than recursion, so deep trees from skewed weights
+    # don't hit the recursion limit; the ')' strings on it close a node
+    parts = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str): parts.append(node)
+        elif node.symbol is not None: parts.append(node.symbol)
+        else:
+            parts.append('(')
+            stack.extend((')', node.right, node.left))
+    return ''.join(parts)
+
+def _write_varint(out, value):
+    # little endian base 128, seven bits per byte, high bit set on all but the last
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("truncated header")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+# Packs a string of 0s and 1s into bytes, most significant bit first, zero
+# padding the last byte. Returns the bytes and the number of padding bits.
+def _pack_bits(bits):
+    padding = -len(bits) % 8
+    if len(bits) == 0:
+        return b'', 0
+    return int(bits + '0' * padding, 2).to_bytes((len(bits) + padding) // 8, 'big'), padding
+
+# Raises ValueError unless `bits` is all 0s and 1s. The decoders read bits
+# with int(chunk, 2), which would also take whitespace, '_' separators and a
+# '0b' prefix, decoding a malformed message as the wrong symbols.
+def _check_bits(bits):
+    if bits.count('0') + bits.count('1') != len(bits):
+        raise ValueError("encoded message may only contain '0' and '1'")
+
+# Packs the whole bytes of a string of 0s and 1s, for the streaming
+# encoders. Returns the bytes and the bits left over for the next byte.
+def _pack_whole_bytes(bits):
+    full_len = len(bits) - len(bits) % 8
+    packed, _ = _pack_bits(bits[:full_len])
+    return packed, bits[full_len:]
+
+# Checks the padding trailer that ends a payload in the `encode_bytes`
+# format and returns the number of code bits before it.
+def _trailer_bits(data):
+    if len(data) == 0:
+        raise ValueError("packed payload is missing its trailer byte")
+
+    padding = data[-1]
+    if padding > 7 or (len(data) == 1 and padding != 0):
+        raise ValueError("invalid padding trailer %d" % padding)
+
+    return (len(data) - 1) * 8 - padding
+
+# Number of code bits in a payload made by `HuffmanTree.encode_bytes`, going
+# by its padding trailer.
+def _payload_bits(payload):
+    payload = memoryview(payload).cast('B')
+    return (len(payload) - 1) * 8 - payload[-1]
+
+# Parses a header written by `HuffmanTree.serialize_header` starting at `pos`.
+# Returns the `(symbol, code_length)` list and the offset just past the header.
+def _read_header(data, pos):
+    data = memoryview(data).cast('B')
+
+    max_length, pos = _read_varint(data, pos)
+    counts = []
+    for _ in range(max_length):
+        count, pos = _read_varint(data, pos)
+        counts.append(count)
+
+    length_list = []
+    for length, count in enumerate(counts, 1):
+        for _ in range(count):
+            size, pos = _read_varint(data, pos)
+            if pos + size > len(data):
+                raise ValueError("truncated header")
+            length_list.append((bytes(data[pos:pos + size]).decode('utf-8'), length))
+            pos += size
+
+    if len(length_list) < 2:
+        raise ValueError("header must describe at least two symbols")
+
+    return length_list, pos
+
+# Counts how often each symbol appears in `data` in one pass, adding into
+# `counts` (a collections.Counter) if given so chunked input can be counted
+# piece by piece and partial counts merged with `+`. Symbols are always
+# strings, so whatever is counted can be decoded back to text. Strings count
+# their characters. Bytes-like data (anything with the buffer protocol, such
+# as bytes, mmap or array('B')) counts byte values, reported as the one
+# character strings chr(0) to chr(255) so they line up with text decoded as
+# latin-1; integer numpy arrays likewise count each value v as chr(v). Any
+# other iterable counts its items as the symbols, so a list of words builds
+# a tree over words, with int items mapped to chr like array values. Raises
+# ValueError for items that are neither.
+def count_symbols(data, counts=None):
+    if counts is None:
+        counts = collections.Counter()
+
+    if isinstance(data, str):
+        counts.update(data)
+        return counts
+
+    # numpy counts go through in CHUNK_SIZE slices: bincount widens its
+    # input to intp, eight bytes per value, which must stay bounded
+    if np is not None and isinstance(data, np.ndarray):
+        values = data.ravel()
+        if data.dtype.kind in 'iu':
+            # bincount would allocate a slot for every value up to the max, so
+            # refuse out of range values first, with _as_symbol's error
+            if len(values) and (values.min() < 0 or values.max() >= 0x110000):
+                _as_symbol(int(values.min() if values.min() < 0 else values.max()))
+            for i in range(0, len(values), CHUNK_SIZE):
+                _count_histogram(counts, np.bincount(values[i:i + CHUNK_SIZE]))
+        else:
+            _count_items(counts, values.tolist())
+        return counts
+
+    try:
+        buf = memoryview(data)
+    except TypeError:
+        _count_items(counts, data)
+        return counts
+
+    if not buf.c_contiguous:
+        buf = memoryview(buf.tobytes())
+    buf = buf.cast('B')
+    if np is not None:
+        histogram = np.zeros(256, dtype=np.int64)
+        for i in range(0, len(buf), CHUNK_SIZE):
+            histogram += np.bincount(np.frombuffer(buf[i:i + CHUNK_SIZE], dtype=np.uint8), minlength=256)
+        _count_histogram(counts, histogram)
+    else:
+        for value, count in collections.Counter(buf).items():
+            counts[chr(value)] += count
+
+    return counts
+
+def _count_histogram(counts, histogram):
+    for value in np.flatnonzero(histogram):
+        counts[chr(value)] += int(histogram[value])
+
+def _count_items(counts, items):
+    for symbol, count in collections.Counter(items).items():
+        counts[_as_symbol(symbol)] += count
+
+# Maps an int to its character like count_symbols does for byte values, so
+# every symbol a tree is built from is a string.
+def _as_symbol(symbol):
+    if isinstance(symbol, str):
+        return symbol
+    if isinstance(symbol, int) and 0 <= symbol < 0x110000:
+        return chr(symbol)
+    raise ValueError("symbols must be strings or ints in range(0x110000), got %r" % (symbol,))
+
+
+# Opt-in metrics for a HuffmanTree, passed as `HuffmanTree(..., stats=...)`.
+# Each call to build, encode, encode_bytes, encode_array, encode_many and the
+# matching decode methods is recorded under its phase ('build', 'encode' or
+# 'decode') as a call count, symbols in or out, code bits and seconds spent.
+# `callback(phase, symbols, bits, seconds)`, if given, is called after every
+# record, e.g. to forward it to a monitoring client. The model fields are
+# filled in when the tree is built: `depth_histogram` maps each code length
+# to how many symbols have it, and `entropy` and `average_code_length` are in
+# bits per symbol under the symbol weights (None when the weights aren't
+# known, as for `from_header`). Trees built without stats pay one `is None`
+# check per call.
+class HuffmanStats:
+    PHASES = ('build', 'encode', 'decode')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.symbols = dict.fromkeys(self.PHASES, 0)
+        self.bits = dict.fromkeys(self.PHASES, 0)
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.depth_histogram = {}
+        self.entropy = None
+        self.average_code_length = None
+
+    def record(self, phase, symbols, bits, seconds):
+        self.calls[phase] += 1
+        self.symbols[phase] += symbols
+        self.bits[phase] += bits
+        self.seconds[phase] += seconds
+        if self.callback is not None:
+            self.callback(phase, symbols, bits, seconds)
+
+    def describe_model(self, length_list, symbol_list=None):
+
+        '''
+
+        Fills in the model fields from the tree's `(symbol, code_length)`
+        list and, when known, the `(symbol, weight)` list it was built from.
+
+        '''
+
+        histogram = collections.Counter(length for _, length in length_list)
+        self.depth_histogram = dict(sorted(histogram.items()))
+
+        self.entropy = None
+        self.average_code_length = None
+        if symbol_list is None:
+            return
+
+        total = sum(weight for _, weight in symbol_list)
+        if total <= 0:
+            return
+
+        lengths = dict(length_list)
+        # probabilities that underflow to zero add nothing measurable
+        probabilities = [weight / total for _, weight in symbol_list]
+        self.entropy = -sum(p * math.log2(p) for p in probabilities if p > 0)
+        self.average_code_length = sum(weight * lengths[symbol] for symbol, weight in symbol_list) / total
+
+    def bits_per_symbol(self, phase='encode'):
+        # the achieved average code length, as opposed to the model's
+        if self.symbols[phase] == 0:
+            return None
+        return self.bits[phase] / self.symbols[phase]
+
+    def compression_ratio(self, symbol_bits=8):
+        # code bits out per `symbol_bits` bits in, over everything encoded
+        if self.symbols['encode'] == 0:
+            return None
+        return self.bits['encode'] / (self.symbols['encode'] * symbol_bits)
+
+    def as_dict(self):
+        return {
+            'calls': dict(self.calls),
+            'symbols': dict(self.symbols),
+            'bits': dict(self.bits),
+            'seconds': dict(self.seconds),
+            'depth_histogram': dict(self.depth_histogram),
+            'entropy': self.entropy,
+            'average_code_length': self.average_code_length,
+            'bits_per_symbol': self.bits_per_symbol(),
+        }
 
 
 class HuffmanTree:
     # Helper object for building the Huffman tree.
     # You may modify this constructor but the grading script rlies on the left, right, and symbol fields.
     class TreeNode:
+        __slots__ = ('left', 'right', 'symbol', 'min_element')
+
         def __init__ (self):
             self.left = None
             self.right = None
             self.symbol = None
             self.min_element = None
 
+    # Array backed form of a whole tree. Nodes are numbered breadth first
+    # with the root at 0. An internal node stores its children's numbers in
+    # `left` and `right`; a leaf has -1 there and its symbol in `symbols`
+    # (None for internal nodes).
+    class FlatTree:
+        __slots__ = ('left', 'right', 'symbols')
+
+        def __init__ (self):
+            self.left = array('i')
+            self.right = array('i')
+            self.symbols = []
+
+    # Read only view of one node of a FlatTree, exposing the same left,
+    # right and symbol fields as TreeNode so BinaryTreeToString and other
+    # node walkers keep working on compact trees.
+    class FlatNode:
+        __slots__ = ('flat', 'index')
+
+        def __init__ (self, flat, index):
+            self.flat = flat
+            self.index = index
+
+        @property
+        def left(self):
+            child = self.flat.left[self.index]
+            return None if child < 0 else HuffmanTree.FlatNode(self.flat, child)
+
+        @property
+        def right(self):
+            child = self.flat.right[self.index]
+            return None if child < 0 else HuffmanTree.FlatNode(self.flat, child)
+
+        @property
+        def symbol(self):
+            return self.flat.symbols[self.index]
+
   # The `symbol_list` argument should be a list of tuples `(symbol, weight)`,
   # where `symbol` is a symbol that can be encoded, and `weight` is the
   # the unnormalized probabilitiy of that symbol appearing.
-    def __init__(self, symbol_list):
+  # `decode_bits` is how many bits the decoder consumes per table lookup.
+  # With `canonical=True` the tree is rebuilt as the canonical Huffman tree
+  # for the same code lengths, so it can be shipped as a compact header.
+  # `build_engine` picks how the tree is built, 'heap' or 'two_queue'; both
+  # give the same tree. With `compact=True` the TreeNode objects are dropped
+  # after the build and `root` becomes a FlatNode view over a FlatTree.
+  # `max_code_length` caps how long any code may get; if the plain tree is
+  # deeper than that, the optimal length limited canonical tree is used.
+  # `stats` is an optional HuffmanStats that the tree records its work in.
+    def __init__(self, symbol_list, decode_bits=8, canonical=False, build_engine='heap', compact=False, max_code_length=None, stats=None):
         assert(len(symbol_list) >= 2)
+        assert(decode_bits >= 1)
+        self.stats = stats
+        if stats is not None:
+            start = time.perf_counter()
         # YOUR CODE HERE
-        self.root = self.build_tree(symbol_list) # (place TreeNode object here)
+        self.root = self.build_tree(symbol_list, build_engine) # (place TreeNode object here)
+        if canonical or max_code_length is not None:
+            lengths = self._build_codebook(self.flatten(self.root))
+            length_list = [(symbol, len(code)) for symbol, code in lengths.items()]
+
+            # too deep, swap in the best codes that fit
+            if max_code_length is not None and max(length for _, length in length_list) > max_code_length:
+                length_list = self.limited_code_lengths(symbol_list, max_code_length)
+                canonical = True
+
+            if canonical:
+                self.root = self.build_canonical_tree(length_list)
+        self._init_tables(decode_bits, canonical, compact)
+
+        if stats is not None:
+            stats.record('build', len(symbol_list), 0, time.perf_counter() - start)
+            stats.describe_model(self.code_lengths(), symbol_list)
+
+    # Shared tail of construction, once `self.root` is in place.
+    def _init_tables(self, decode_bits, canonical, compact=False):
+        self.canonical = canonical
+        if compact:
+            self.root = self.FlatNode(self.get_flat_tree(), 0)
+        self._codebook_root = None  # root the cached codebook was derived from
+        self.codebook = self.get_codebook()  # symbol -> code, derived once
+        self.decode_bits = decode_bits
+        self._decode_tables = {}  # k -> lookup table, built lazily by decode
+        self._decode_root = None  # root the cached decode tables belong to
+        self._walked_bits = 0  # bits decoded before the k-bit table was built
+        self._array_tables = {}  # 'encode'/'decode' -> numpy tables for byte alphabets
+        self._array_root = None  # root the cached numpy tables belong to
+        self._pool = None  # worker_pool kept between encode_parallel/decode_parallel calls
+
+    @classmethod
+    def from_data(cls, data, **kwargs):
+
+        '''
+
+        Builds a tree straight from raw data, counting the symbols with
+        count_symbols. `data` may also be a dict or Counter of symbol counts
+        that was already merged from chunks, whose int symbols are mapped to
+        characters the same way. Extra keyword arguments go to the
+        constructor.
+
+        '''
+
+        if isinstance(data, dict):
+            counts = collections.Counter()
+            for symbol, count in data.items():
+                counts[_as_symbol(symbol)] += count
+        else:
+            counts = count_symbols(data)
+
+        symbol_list = sorted(counts.items())
+        if len(symbol_list) == 0:
+            raise ValueError("cannot build a tree from empty data")
 
-    def build_tree(self, symbol_list):
+        # a tree needs two leaves, so pair a lone symbol with an unused one
+        if len(symbol_list) == 1:
+            filler = '\x00' if symbol_list[0][0] != '\x00' else '\x01'
+            symbol_list.append((filler, 0))
+
+        return cls(symbol_list, **kwargs)
+
+    def build_tree(self, symbol_list, engine='heap'):
 
         '''
 
@@ -38,9 +420,15 @@ class HuffmanTree:
         popping 2 elements from the heap at a time, combines
         those into one node and reinserts the new node into the heap.  It repeats
         this process until there is one remaining node, which is the root of the tree.
+        With engine='two_queue' the linear time two queue build is used instead.
 
         '''
 
+        if engine == 'two_queue':
+            return self._build_tree_two_queue(symbol_list)
+        elif engine != 'heap':
+            raise ValueError("unknown build engine %r" % (engine,))
+
         symbol_hpq = self._make_heap(symbol_list)  # create a heap of the symbol list
 
         # keep looping until 1 node left
@@ -96,9 +484,8 @@ class HuffmanTree:
         '''
 
         li = []  # start with a list
-        heapq.heapify(li)  # heapify it
 
-        # run through symbol list, create tree nodes, and add tuples to a heap
+        # run through symbol list, create tree nodes, and add tuples to the list
         for elem in symbol_list:
             # convert each symbol pair to a treenode
 
@@ -108,65 +495,458 @@ class HuffmanTree:
             new_node.min_element = elem[0]  # set the min element initially to be the letter as well
 
             temp = (weight, new_node.min_element, new_node)  # create a temp tuple with the weight and treenode
-            heapq.heappush(li, temp)  # heap push the tuple
+            li.append(temp)
+
+        heapq.heapify(li)  # heapify once, O(n) instead of n pushes
 
         return li  # return the li list (heapified)
 
+    def _build_tree_two_queue(self, symbol_list):
+
+        '''
+
+        This function builds the same huffman tree as the heap build in
+        linear time once the leaves are sorted. Leaves sit in one queue in
+        (weight, symbol) order. Merged nodes go to the back of a second
+        queue, and they come out already in (weight, min_element) order.
+        So the two smallest nodes are always at the fronts of the two
+        queues, and popping the smaller front gives the heap's pop order,
+        tie-break included.
+
+        '''
+
+        leaves = []
+        for symbol, weight in symbol_list:
+            new_node = self.TreeNode()
+            new_node.symbol = symbol
+            new_node.min_element = symbol
+            leaves.append((weight, symbol, new_node))
+
+        # timsort is linear when the weights already come sorted
+        leaves.sort(key=lambda leaf: (leaf[0], leaf[1]))
+
+        # consumed entries are dropped from both queues right away so the
+        # live object graph shrinks as the tree grows, like the heap does
+        leaves = collections.deque(leaves)
+        merged = collections.deque()
+        TreeNode = self.TreeNode
+
+        for _ in range(len(leaves) - 1):
+
+            # pop the smaller front twice, comparing (weight, min_element) only
+            if not merged:
+                first_tuple = leaves.popleft()
+            elif not leaves:
+                first_tuple = merged.popleft()
+            else:
+                leaf = leaves[0]
+                node = merged[0]
+                if node[0] < leaf[0] or (node[0] == leaf[0] and node[1] < leaf[1]):
+                    first_tuple = merged.popleft()
+                else:
+                    first_tuple = leaves.popleft()
+
+            if not merged:
+                second_tuple = leaves.popleft()
+            elif not leaves:
+                second_tuple = merged.popleft()
+            else:
+                leaf = leaves[0]
+                node = merged[0]
+                if node[0] < leaf[0] or (node[0] == leaf[0] and node[1] < leaf[1]):
+                    second_tuple = merged.popleft()
+                else:
+                    second_tuple = leaves.popleft()
+
+            new_node = TreeNode()
+            new_node.left = first_tuple[2]
+            new_node.right = second_tuple[2]
+            if first_tuple[1] < second_tuple[1]:
+                new_node.min_element = first_tuple[1]
+            else:
+                new_node.min_element = second_tuple[1]
+
+            merged.append((first_tuple[0] + second_tuple[0], new_node.min_element, new_node))
+
+        return merged[0][2]
+
+    def build_canonical_tree(self, length_list):
+
+        '''
+
+        This function builds the canonical huffman tree for a list of
+        `(symbol, code_length)` tuples. Symbols are ordered by code length and
+        then by symbol, the same ordering min_element uses to break ties,
+        and handed consecutive codes. No heap work is needed, so this is
+        linear in the total code length.
+
+        '''
+
+        ordered = sorted(length_list, key=lambda pair: (pair[1], pair[0]))
+
+        root = self.TreeNode()
+        code = 0
+        prev_length = 0
+
+        for symbol, length in ordered:
+            if length < 1:
+                raise ValueError("code length for %r must be at least 1" % (symbol,))
+
+            code <<= (length - prev_length)  # move down to the new length
+            prev_length = length
+            if code >> length:
+                raise ValueError("code lengths are oversubscribed")
+
+            # walk the code from the root, creating internal nodes as needed
+            node = root
+            for shift in range(length - 1, -1, -1):
+                if node.min_element is None or symbol < node.min_element:
+                    node.min_element = symbol
+                if (code >> shift) & 1:
+                    if node.right is None:
+                        node.right = self.TreeNode()
+                    node = node.right
+                else:
+                    if node.left is None:
+                        node.left = self.TreeNode()
+                    node = node.left
+
+            node.symbol = symbol
+            node.min_element = symbol
+            code += 1
+
+        # every internal node needs two children for decoding to work
+        if code != 1 << prev_length:
+            raise ValueError("code lengths do not form a complete prefix code")
+
+        return root
+
+    def limited_code_lengths(self, symbol_list, max_code_length):
+
+        '''
+
+        This function finds optimal code lengths no longer than
+        `max_code_length` with the package-merge algorithm. Each of the
+        max_code_length - 1 rounds pairs up the current list into packages
+        and merges the packages back in with the leaves by weight. The
+        cheapest 2n - 2 items of the final list then say how long each
+        code is: a symbol's length is how many of them it appears in.
+        Returns a list of `(symbol, code_length)` tuples.
+
+        '''
+
+        num_symbols = len(symbol_list)
+        if max_code_length < 1 or (1 << max_code_length) < num_symbols:
+            raise ValueError("%d symbols don't fit in codes of at most %d bits" % (num_symbols, max_code_length))
+
+        # leaves in (weight, symbol) order, ties going the same way as min_element
+        ordered = sorted(symbol_list, key=lambda pair: (pair[1], pair[0]))
+        leaves = [(weight, None, i) for i, (_, weight) in enumerate(ordered)]
+
+        # items are (weight, children, leaf index); packages have children
+        items = leaves
+        for _ in range(max_code_length - 1):
+            packages = [(items[i][0] + items[i + 1][0], (items[i], items[i + 1]), -1)
+                        for i in range(0, len(items) - 1, 2)]
+            # stable merge, so a leaf goes before a package of equal weight
+            items = list(heapq.merge(leaves, packages, key=lambda item: item[0]))
+
+        # count the leaves inside each selected item
+        lengths = [0] * num_symbols
+        stack = items[:2 * num_symbols - 2]
+        while stack:
+            item = stack.pop()
+            if item[1] is None:
+                lengths[item[2]] += 1
+            else:
+                stack.extend(item[1])
+
+        return [(ordered[i][0], lengths[i]) for i in range(num_symbols)]
+
+    def code_lengths(self):
+
+        '''
+
+        Returns a list of `(symbol, code_length)` tuples in canonical order.
+
+        '''
+
+        codebook = self.get_codebook()
+        lengths = [(symbol, len(code)) for symbol, code in codebook.items()]
+        lengths.sort(key=lambda pair: (pair[1], pair[0]))
+
+        return lengths
+
+    # Serializes the code lengths of a canonical tree. The header is a varint
+    # max code length, a varint symbol count for every length from 1 up to
+    # the max, then every symbol in canonical order as a varint byte length
+    # followed by its UTF-8 bytes.
+    def serialize_header(self):
+
+        '''
+
+        Returns the compact header `from_header` rebuilds this tree from.
+        Only canonical trees can be described by their lengths alone, and
+        only string symbols have a byte form to write; anything else raises
+        ValueError.
+
+        '''
+
+        if not self.canonical:
+            raise ValueError("only canonical trees can be serialized; build with canonical=True")
+
+        lengths = self.code_lengths()
+        max_length = lengths[-1][1]
+
+        counts = [0] * (max_length + 1)
+        for _, length in lengths:
+            counts[length] += 1
+
+        out = bytearray()
+        _write_varint(out, max_length)
+        for length in range(1, max_length + 1):
+            _write_varint(out, counts[length])
+
+        for symbol, _ in lengths:
+            if not isinstance(symbol, str):
+                raise ValueError("only string symbols can be serialized, got %r" % (symbol,))
+            raw = symbol.encode('utf-8')
+            _write_varint(out, len(raw))
+            out += raw
+
+        return bytes(out)
+
+    @classmethod
+    def from_header(cls, data, decode_bits=8, compact=False, stats=None):
+
+        '''
+
+        Rebuilds a canonical tree from a header made by `serialize_header`.
+        Any bytes after the header are ignored.
+
+        '''
+
+        if stats is not None:
+            start = time.perf_counter()
+
+        length_list, _ = _read_header(data, 0)
+
+        tree = cls.__new__(cls)
+        tree.stats = stats
+        tree.root = tree.build_canonical_tree(length_list)
+        tree._init_tables(decode_bits, True, compact)
+
+        if stats is not None:
+            stats.record('build', len(length_list), 0, time.perf_counter() - start)
+            stats.describe_model(length_list)
+
+        return tree
+
+    # Trees are pickled to ship them to worker processes (encode_parallel).
+    # The root goes as a FlatNode over the FlatTree arrays, since pickling a
+    # deep graph of TreeNodes recurses once per level; an unpickled tree is
+    # therefore always compact. The cached tables stay valid for the new
+    # root. The stats stay behind: a worker's counts would never make it
+    # back, and the callback may not pickle.
+    def __getstate__(self):
+        flat = self.get_flat_tree()
+        state = self.__dict__.copy()
+        state['stats'] = None
+        state['_pool'] = None
+
+        if not isinstance(self.root, self.FlatNode):
+            root = self.FlatNode(flat, 0)
+            state['root'] = root
+            for cached in ('_codebook_root', '_decode_root', '_array_root'):
+                if state[cached] is self.root:
+                    state[cached] = root
+
+        return state
+
+    def get_flat_tree(self):
+
+        '''
+
+        Returns the FlatTree for the current root. A compact tree already is
+        one. Other trees are flattened afresh on each call instead of keeping
+        a second copy of the tree next to its nodes; the callers (codebook,
+        decode tables, pickling) only need it once per root.
+
+        '''
+
+        return self.flatten(self.root)
+
+    def flatten(self, root):
+
+        '''
+
+        Copies a tree of nodes into a FlatTree, numbering nodes breadth first
+        so the root is 0 and every parent comes before its children.
+
+        '''
+
+        # already flat, nothing to copy
+        if isinstance(root, self.FlatNode) and root.index == 0:
+            return root.flat
+
+        flat = self.FlatTree()
+        left = flat.left
+        right = flat.right
+        symbols = flat.symbols
+
+        nodes = [root]
+        for node in nodes:
+            if node.symbol is not None:
+                left.append(-1)
+                right.append(-1)
+            else:
+                left.append(len(nodes))
+                nodes.append(node.left)
+                right.append(len(nodes))
+                nodes.append(node.right)
+            symbols.append(node.symbol)
+
+        return flat
+
+    def get_codebook(self):
+
+        '''
+
+        Returns a dict mapping every symbol to its code string. The table is
+        derived once from the tree and rebuilt only if `self.root` has been
+        replaced since the last call (e.g. after calling build_tree again).
+
+        '''
+
+        if self._codebook_root is not self.root:
+            self.codebook = self._build_codebook(self.get_flat_tree())
+            self._codebook_root = self.root
+
+        return self.codebook
+
+    def _build_codebook(self, flat):
+
+        '''
+
+        Walks a FlatTree once with an explicit stack, recording the path to
+        every leaf as that leaf's code.
+
+        '''
+
+        left = flat.left
+        right = flat.right
+        symbols = flat.symbols
+
+        codebook = {}
+        stack = [(0, '')]
+
+        while stack:
+            node, code = stack.pop()
+
+            # leaf node, the path so far is its code
+            if left[node] < 0:
+                codebook[symbols[node]] = code
+                continue
+
+            stack.append((right[node], code + '1'))
+            stack.append((left[node], code + '0'))
+
+        return codebook
+
   # Encodes a string of characters into a string of bits using the
   # symbol/weight list provided.
     def encode(self, s):
 
         '''
 
-        Takes a string s and encodes it into 0s and 1s based on traversing the 
-        huffman tree.
+        Takes a string s and encodes it into 0s and 1s by looking up each
+        character in the precomputed codebook and joining the codes once.
 
         '''
 
         assert(s is not None)
 
+        if self.stats is not None:
+            start = time.perf_counter()
+            encoded = self._encode(s)
+            self.stats.record('encode', len(s), len(encoded), time.perf_counter() - start)
+            return encoded
+
+        return self._encode(s)
+
+    def _encode(self, s):
         # if s is '', return same
         if len(s) == 0:
             return ''
 
-        encoded_str = ''  # the return ans
+        codebook = self.get_codebook()
 
-        # for every char in s
-        for char in s:
-            char_code = ''
+        # unknown characters have no code and contribute nothing, same as the
+        # old tree search which came back empty for them
+        return ''.join([codebook.get(char, '') for char in s])
 
-            # use the encode helper function
-            encoded_char = self._encode_helper(self.root, char, char_code)
-            encoded_str += encoded_char  # append to the running string
+    def _encode_helper(self, root, char, char_code):
 
-        return encoded_str
+        '''
 
-    def _encode_helper(self, root, char, char_code):
+        A helper function that searches the huffman tree depth first for
+        the leaf holding char, returning its code prefixed by char_code, or
+        '' if it isn't there. Kept for callers that search the tree directly;
+        encode() uses the codebook instead.
 
         '''
 
-        A helper function that recursively traverses the huffman tree
-        until it reaches a leaf node, returning the symbol value
+        # explicit stack of (node, depth, bit taken to reach it), with the
+        # bits of the current path kept in one list instead of a new string
+        # per level, so deep trees cost neither recursion nor quadratic copies
+        path = []
+        found = []
+        stack = [(root, 0, None)]
+
+        while stack:
+            node, depth, bit = stack.pop()
+            del path[depth:]
+            if bit is not None:
+                path.append(bit)
+
+            # if a leaf node, it will have a letter
+            if node.symbol is not None:
+                # if it's the right letter, note its code
+                if node.symbol == char:
+                    found.append(char_code + ''.join(path))
+                continue
+
+            # not a leaf node, go both directions, left first
+            stack.append((node.right, len(path), '1'))
+            stack.append((node.left, len(path), '0'))
 
+        return ''.join(found)
+
+    # Encodes a string of characters into packed bytes. The code bits are
+    # stored most significant bit first, zero padded to a whole byte, and
+    # followed by one trailer byte holding the number of padding bits (0-7).
+    def encode_bytes(self, s):
 
         '''
 
-        # if a leaf node, it will have a letter
-        if root.symbol is not None:
+        Takes a string s and encodes it into packed bytes, eight code bits
+        per byte, so the payload can be written straight to a file or socket.
 
-            # if it's the right letter, return the char_code
-            if root.symbol == char:
-                return char_code
-            # else it's not the letter, so return empty str
-            else:
-                return ''
+        '''
+
+        if self.stats is not None:
+            start = time.perf_counter()
+            payload = self._encode_bytes(s)
+            self.stats.record('encode', len(s), _payload_bits(payload), time.perf_counter() - start)
+            return payload
 
-        # if not a leaf node, recursively call, going both direction
-        # will be empty is it doesn't find the leaf node matching the symbol
-        left = self._encode_helper(root.left, char, char_code + '0')
-        right = self._encode_helper(root.right, char, char_code + '1')
+        return self._encode_bytes(s)
 
-        return left + right  # return both, since one will be empty
+    def _encode_bytes(self, s):
+        packed, padding = _pack_bits(self._encode(s))
+
+        # the empty message is just the trailer
+        return packed + bytes([padding])
 
     # Decodes a string of bits into a string of characters using the
     # symbol/weight list provided.
@@ -175,23 +955,178 @@ class HuffmanTree:
 
         '''
 
-        This function decodes a 0s and 1s string into letters, using a helper
-        function to loop through the string, finding one letter at a time.
+        This function decodes a 0s and 1s string into letters. It feeds the
+        message through the k-bit lookup table `decode_bits` bits at a time,
+        then finishes any leftover bits one at a time. Raises ValueError if
+        the message holds anything but 0s and 1s.
 
         '''
 
         assert(encoded_msg is not None)
 
+        if self.stats is not None:
+            start = time.perf_counter()
+            decoded = self._decode(encoded_msg)
+            self.stats.record('decode', 0 if decoded is None else len(decoded), len(encoded_msg),
+                              time.perf_counter() - start)
+            return decoded
+
+        return self._decode(encoded_msg)
+
+    def _decode(self, encoded_msg):
         # if string len empty, return ''
         if len(encoded_msg) == 0:
             return ''
 
-        msg_so_far = ''  # the starting message
+        decoded, state = self._decode_bits(encoded_msg, 0)
+
+        # have leftover bits that stopped partway down the tree, so cant decode
+        if state != 0:
+            return None
+
+        return ''.join(decoded)
+
+    def _decode_bits(self, encoded_msg, state):
+
+        '''
+
+        Walks a 0s and 1s string starting from internal node `state` (0 is
+        the root). Returns the list of decoded symbols and the state the walk
+        ended in, so a caller can pick up where it left off.
+
+        '''
+
+        _check_bits(encoded_msg)
+
+        msg_len = len(encoded_msg)
+        k, table = self._table_for(self.decode_bits, msg_len)
+        emit, next_state = table
+        step_emit, step_next = self._get_decode_table(1)
+
+        full_len = msg_len - msg_len % k  # bits covered by whole k-bit chunks
+
+        decoded = []
+
+        # one lookup per k bits, emitting every symbol completed in the chunk
+        for i in range(0, full_len, k):
+            entry = (state << k) | int(encoded_msg[i:i + k], 2)
+            if emit[entry]:
+                decoded.extend(emit[entry])
+            state = next_state[entry]
+
+        # the tail that doesn't fill a chunk goes bit by bit
+        for bit in encoded_msg[full_len:]:
+            entry = (state << 1) | int(bit, 2)
+            if step_emit[entry]:
+                decoded.extend(step_emit[entry])
+            state = step_next[entry]
+
+        return decoded, state
+
+    def _get_decode_table(self, k):
+
+        '''
+
+        Returns the k-bit decode table, building it on first use. The table is
+        a pair of flat lists `(emit, next_state)` indexed by
+        `(state << k) | chunk`, where `state` numbers an internal node (0 is
+        the root) and `chunk` is the next k bits read most significant bit
+        first. `emit` holds the tuple of symbols completed while walking those
+        k bits and `next_state` the internal node the walk ends in.
+
+        '''
+
+        # throw away tables built for a tree that has since been replaced
+        if self._decode_root is not self.root:
+            self._decode_tables = {}
+            self._decode_root = self.root
+            self._walked_bits = 0
+
+        table = self._decode_tables.get(k)
+        if table is None:
+            table = self._build_decode_table(k)
+            self._decode_tables[k] = table
+
+        return table
+
+    def _table_for(self, k, num_bits):
+
+        '''
+
+        Picks the table for decoding `num_bits` more bits: returns `(k, table)`
+        once the k-bit table is worth having, and `(1, step table)` before
+        that. Building the k-bit table costs a step for each of its entries,
+        so it is only built after the bits walked singly would have paid for
+        it. Short messages on a fresh tree never build it at all.
+
+        '''
+
+        step = self._get_decode_table(1)
+        table = self._decode_tables.get(k)
+        if table is not None:
+            return k, table
+
+        # the step table has two entries per state
+        self._walked_bits += num_bits
+        if self._walked_bits < len(step[1]) << (k - 1):
+            return 1, step
+
+        return k, self._get_decode_table(k)
+
+    def _build_decode_table(self, k):
+
+        '''
+
+        Builds the k-bit table one bit at a time: the (j+1)-bit entries of a
+        state are the j-bit entries extended by a single step left or right,
+        so each of the 2^k entries per state costs one step to fill. Equal
+        symbol tuples are shared, which keeps `emit` down to a list of
+        references.
 
-        # call the helper function
-        decoded_msg = self._decode_helper(self.root, encoded_msg, msg_so_far)
+        '''
 
-        return decoded_msg
+        flat = self.get_flat_tree()
+        left = flat.left
+        right = flat.right
+        symbols = flat.symbols
+
+        # number the internal nodes in flat order, which puts the root first
+        internal = [node for node in range(len(left)) if left[node] >= 0]
+        state_of = array('i', [-1]) * len(left)
+        for state, node in enumerate(internal):
+            state_of[node] = state
+
+        # single step from each internal node: (symbol or None, next state)
+        steps = []
+        for node in internal:
+            for child in (left[node], right[node]):
+                if left[child] < 0:
+                    steps.append((symbols[child], 0))  # leaf, back to the root
+                else:
+                    steps.append((None, state_of[child]))
+
+        emit = []
+        next_state = array('i')
+        shared = {}
+        for state in range(len(internal)):
+            entries = [((), state)]
+
+            for _ in range(k):
+                longer = []
+                for symbols, node_state in entries:
+                    for bit in (0, 1):
+                        symbol, stepped = steps[(node_state << 1) | bit]
+                        if symbol is not None:
+                            longer.append((symbols + (symbol,), stepped))
+                        else:
+                            longer.append((symbols, stepped))
+                entries = longer
+
+            for symbols, node_state in entries:
+                emit.append(shared.setdefault(symbols, symbols))
+                next_state.append(node_state)
+
+        return emit, next_state
 
     def _decode_helper(self, root, encoded_msg, msg_so_far):
 
@@ -200,20 +1135,15 @@ class HuffmanTree:
         This helper function loops through the encoded message and traverses
         the tree based on a 0 or 1, going left or right, respectively.
         When it reaches a leaf node, it appends a letter, and starts the
-        current root node back to the top of the tree.
+        current root node back to the top of the tree. This is the one bit
+        at a time walk; decode() uses the lookup tables instead.
 
         '''
 
-        # loop through encoded 0s and 1s
-        while len(encoded_msg) > 0:
-
-            # if leaf node
-            if root.symbol is not None:
-                msg_so_far += root.symbol  # append to msg
-                root = self.root  # restart root from the top
-                continue
+        decoded = [msg_so_far]
 
-            next_char = encoded_msg[0]  # peek at the next char
+        # loop through encoded 0s and 1s
+        for next_char in encoded_msg:
 
             # if 0 or 1, go left or right
             if next_char == '0':
@@ -221,19 +1151,1529 @@ class HuffmanTree:
             elif next_char == '1':
                 root = root.right
 
-            # after, remove the first letter in encoded message
-            encoded_msg = encoded_msg[1:]  # update the encoded msg
+            # if leaf node
+            if root.symbol is not None:
+                decoded.append(root.symbol)  # append to msg
+                root = self.root  # restart root from the top
 
-        # need to do one more check after while loop
-        if root.symbol is not None:
-            msg_so_far += root.symbol  # append to msg
-        # have leftover str so cant decode
-        else:
-            # the way to tell if the encoded message can't be decoded is
-            # when the last letter traverses the tree and lands on a
-            # non leaf node, in which case, return None
+        # the way to tell if the encoded message can't be decoded is
+        # when the last letter traverses the tree and lands on a
+        # non leaf node, in which case, return None
+        if root is not self.root:
             return None
 
         # return the decoded message
-        return msg_so_far
+        return ''.join(decoded)
+
+    # Decodes packed bytes produced by `encode_bytes` back into a string of
+    # characters. Accepts bytes, bytearray or memoryview.
+    def decode_bytes(self, data):
+
+        '''
+
+        This function decodes a packed payload, reading whole bytes through
+        the 8-bit lookup table. Like decode(), it returns None if the bits
+        stop partway down the tree.
+
+        '''
+
+        assert(data is not None)
+
+        if self.stats is not None:
+            start = time.perf_counter()
+            decoded = self._decode_bytes(data)
+            self.stats.record('decode', 0 if decoded is None else len(decoded), _payload_bits(data),
+                              time.perf_counter() - start)
+            return decoded
+
+        return self._decode_bytes(data)
+
+    def _decode_bytes(self, data):
+        data = memoryview(data).cast('B')
+        decoded, state = self._decode_packed(data, 0, _trailer_bits(data))
+
+        # have leftover bits so cant decode
+        if state != 0:
+            return None
+
+        return ''.join(decoded)
+
+    def _decode_packed(self, data, bit_start, bit_end, state=0):
+
+        '''
+
+        Decodes bits `bit_start` up to `bit_end` of a packed byte buffer,
+        starting from internal node `state`. Bits before the first byte
+        boundary and after the last one are walked singly; the bytes in
+        between go through the 8-bit table. Returns the list of decoded
+        symbols and the state the walk ended in.
+
+        '''
+
+        step_emit, step_next = self._get_decode_table(1)
+
+        decoded = []
+        pos = bit_start
+
+        # single bits up to the first byte boundary
+        head_end = min(bit_end, (bit_start + 7) & ~7)
+        while pos < head_end:
+            entry = (state << 1) | ((data[pos >> 3] >> (7 - (pos & 7))) & 1)
+            if step_emit[entry]:
+                decoded.extend(step_emit[entry])
+            state = step_next[entry]
+            pos += 1
+
+        # whole bytes, one lookup each once the byte table has paid off
+        full_end = bit_end & ~7
+        if pos < full_end:
+            k, (emit, next_state) = self._table_for(8, full_end - pos)
+            if k == 8:
+                for byte in data[pos >> 3:full_end >> 3]:
+                    entry = (state << 8) | byte
+                    if emit[entry]:
+                        decoded.extend(emit[entry])
+                    state = next_state[entry]
+                pos = full_end
+
+        # single bits left in the last partial byte, or all of them
+        while pos < bit_end:
+            entry = (state << 1) | ((data[pos >> 3] >> (7 - (pos & 7))) & 1)
+            if step_emit[entry]:
+                decoded.extend(step_emit[entry])
+            state = step_next[entry]
+            pos += 1
+
+        return decoded, state
+
+
+    # Encodes a bytes-like object or integer numpy array of byte values with
+    # vectorized numpy code, for trees whose symbols are the byte characters
+    # chr(0)..chr(255) (as built by `from_data` on bytes). The output is the
+    # same as `encode_bytes` on the data read as latin-1, which is also the
+    # fallback when numpy isn't installed, the tree's symbols aren't bytes,
+    # or a code is longer than 64 bits. Raises ValueError for arrays that
+    # aren't integers in 0..255.
+    def encode_array(self, data):
+
+        '''
+
+        Looks up each pair of bytes in a table of their two codes joined and
+        left aligned in a 64-bit word (single bytes when codes are longer
+        than 32 bits), finds where each starts with a cumulative sum of the
+        lengths, and ors the shifted codes into the output words with one
+        reduceat per word half. Input goes through in slices so temporary
+        arrays stay bounded.
+
+        '''
+
+        if self.stats is not None:
+            start = time.perf_counter()
+            payload = self._encode_array(data)
+            size = data.size if np is not None and isinstance(data, np.ndarray) else len(memoryview(data).cast('B'))
+            self.stats.record('encode', size, _payload_bits(payload),
+                              time.perf_counter() - start)
+            return payload
+
+        return self._encode_array(data)
+
+    def _encode_array(self, data):
+        if np is not None and isinstance(data, np.ndarray):
+            if data.dtype != np.uint8:
+                # astype would wrap 300 to 44 and truncate 65.5 to 65
+                if data.dtype.kind not in 'iu' or (data.size and (data.min() < 0 or data.max() > 255)):
+                    raise ValueError("encode_array needs byte values 0..255, got a %s array" % data.dtype)
+                data = data.astype(np.uint8)
+            data = data.ravel()
+
+        tables = self._get_array_tables('encode')
+        if tables is None:
+            return self._encode_bytes(bytes(memoryview(data).cast('B')).decode('latin-1'))
+
+        codes, lengths, paired = tables
+        arr = np.frombuffer(memoryview(data).cast('B'), dtype=np.uint8)
+
+        one = np.uint64(1)
+        out = []
+        carry = np.uint64(0)  # word still being filled
+        carry_bits = 0  # bits of it in use
+        chunk_symbols = 1 << 20
+
+        for first in range(0, len(arr), chunk_symbols):
+            part = arr[first:first + chunk_symbols]
+
+            # pair i is bytes 2i and 2i + 1, an odd last byte pairs with the
+            # empty code at 256
+            if paired:
+                units = part[0::2].astype(np.int32) * 257
+                units[:len(part) >> 1] += part[1::2]
+                if len(part) & 1:
+                    units[-1] += 256
+            else:
+                units = part
+
+            # where each unit's bits start, counted from the start of the carry word
+            unit_lengths = lengths[units]
+            ends = np.cumsum(unit_lengths)
+            ends += carry_bits
+            starts = ends - unit_lengths
+            words = starts >> 6
+            offsets = (starts & 63).astype(np.uint64)
+
+            # the part of each code in its first word, and whatever spills
+            # into the next; the double shift keeps shifts below 64
+            unit_codes = codes[units]
+            high = unit_codes >> offsets
+            low = (unit_codes << one) << (np.uint64(63) - offsets)
+
+            used_bits = int(ends[-1])
+            packed = np.zeros((used_bits >> 6) + 2, dtype=np.uint64)
+            packed[0] = carry
+            group = np.flatnonzero(np.diff(words, prepend=-1))
+            packed[words[group]] |= np.bitwise_or.reduceat(high, group)
+            packed[words[group] + 1] |= np.bitwise_or.reduceat(low, group)
+
+            # whole words are done; the last one may still be partial
+            out.append(packed[:used_bits >> 6].astype('>u8').tobytes())
+            carry = packed[used_bits >> 6]
+            carry_bits = used_bits & 63
+
+        out.append(np.array([carry], dtype='>u8').tobytes()[:(carry_bits + 7) >> 3])
+
+        return b''.join(out) + bytes([-carry_bits % 8])
+
+    # Decodes a payload in the `encode_bytes` format back into bytes with
+    # vectorized numpy code, for byte alphabet trees. Returns None if the
+    # payload can't be decoded. Falls back to `decode_bytes` when numpy isn't
+    # installed or the tree's symbols aren't bytes.
+    def decode_array(self, payload):
+
+        '''
+
+        Runs the 8-bit decode table over many blocks of the payload in
+        lockstep, one numpy gather per byte position. Only the first block
+        knows its true start state; the others start at the root and are
+        redone from their predecessor's end state until all agree. Huffman
+        codes usually resynchronize within a few codes, so that takes one
+        redo. Blocks are sized so codes all of one length start every block
+        at the root. Other codes that don't resynchronize show up as a redo
+        that leaves most blocks still wrong; the rest of the payload is then
+        decoded with the 8-bit table, and so is every later payload for this
+        tree. Payloads go through in slices so temporary arrays stay bounded.
+
+        '''
+
+        if self.stats is not None:
+            start = time.perf_counter()
+            decoded = self._decode_array(payload)
+            self.stats.record('decode', 0 if decoded is None else len(decoded), _payload_bits(payload),
+                              time.perf_counter() - start)
+            return decoded
+
+        return self._decode_array(payload)
+
+    def _decode_array(self, payload):
+        tables = self._get_array_tables('decode')
+        if tables is None:
+            decoded = self._decode_bytes(payload)
+            return None if decoded is None else decoded.encode('latin-1')
+
+        next_state, emit_count, emit_symbols, block_bytes = tables
+
+        data = memoryview(payload).cast('B')
+        num_bits = _trailer_bits(data)
+        full_bytes = num_bits >> 3
+        body = np.frombuffer(data[:full_bytes], dtype=np.uint8)
+
+        # a code known not to resynchronize gains nothing from the blocks
+        if block_bytes == 0:
+            decoded, state = self._decode_packed(data, 0, num_bits)
+            return None if state != 0 else ''.join(decoded).encode('latin-1')
+
+        slice_bytes = block_bytes << 14
+        max_redo = 2
+        pieces = []
+        state = 0
+        resume = full_bytes * 8  # where the bit at a time decoding picks up
+
+        for first in range(0, full_bytes, slice_bytes):
+            chunk = body[first:first + slice_bytes]
+            num_blocks = -(-len(chunk) // block_bytes)
+
+            # byte j of every block in row j; 256 is a no-op padding the last block
+            grid = np.full(num_blocks * block_bytes, 256, dtype=np.int32)
+            grid[:len(chunk)] = chunk
+            grid = np.ascontiguousarray(grid.reshape(num_blocks, block_bytes).T)
+
+            entries = np.empty((block_bytes, num_blocks), dtype=np.int32)
+            block_start = np.zeros(num_blocks, dtype=np.int32)
+            block_start[0] = state
+
+            redo = None  # None means every block
+            passes = 0
+            while True:
+                if redo is None:
+                    states = block_start.copy()
+                    for j in range(block_bytes):
+                        entry = states * 257 + grid[j]
+                        entries[j] = entry
+                        states = next_state[entry]
+                    block_end = states
+                else:
+                    states = block_start[redo]
+                    for j in range(block_bytes):
+                        entry = states * 257 + grid[j, redo]
+                        entries[j, redo] = entry
+                        states = next_state[entry]
+                    block_end[redo] = states
+
+                # a block is right once it starts where the block before it ended
+                expected = np.concatenate(([state], block_end[:-1]))
+                wrong = np.flatnonzero(expected != block_start)
+                if len(wrong) == 0:
+                    break
+
+                # resynchronizing codes fix nearly every block per redo, so
+                # a redo that leaves most of them wrong means this code won't
+                if redo is not None and len(wrong) * 2 > len(redo):
+                    self._array_tables['decode'] = tables[:3] + (0,)
+                    break
+                if passes == max_redo:
+                    break
+
+                redo = wrong
+                block_start[redo] = expected[redo]
+                passes += 1
+
+            # not converging: the blocks before the first wrong one are
+            # right, everything from there on is left to _decode_packed
+            if len(wrong):
+                good = int(wrong[0])
+                entries = entries[:, :good]
+                state = int(expected[good])
+                resume = (first + good * block_bytes) * 8
+
+            # back to block order, then every symbol each lookup emitted:
+            # lookup i emitted counts[i] symbols, from slot 0 of its entry up
+            entries = entries.T.ravel()
+            counts = emit_count[entries]
+            source = np.repeat(entries, counts)
+            first_out = (np.cumsum(counts, dtype=np.int32) - counts).astype(np.int32)
+            slot = np.arange(len(source), dtype=np.int32) - np.repeat(first_out, counts)
+            pieces.append(emit_symbols[source * 8 + slot])
+            if len(wrong):
+                break
+            state = int(block_end[-1])
+
+        decoded = b''.join(piece.tobytes() for piece in pieces)
+
+        # bits of the last partial byte, or everything the blocks left over
+        tail, state = self._decode_packed(data, resume, num_bits, state)
+
+        # have leftover bits so cant decode
+        if state != 0:
+            return None
+
+        return decoded + ''.join(tail).encode('latin-1')
+
+    def _get_array_tables(self, kind):
+
+        '''
+
+        Returns the numpy tables encode_array (kind 'encode') or decode_array
+        (kind 'decode') needs, or None when numpy is missing or some symbol
+        isn't a byte character. The encode tables are `(codes, lengths,
+        paired)`, each code left aligned in a 64-bit word. When every code
+        fits in 32 bits they are indexed by pairs of bytes, a * 257 + b with
+        b = 256 standing for no byte, and hold the two codes joined;
+        otherwise by single bytes. Codes longer than 64 bits get None. The
+        decode tables are `(next_state, emit_count, emit_symbols,
+        block_bytes)`, the 8-bit decode table flattened and indexed by
+        state * 257 + byte with byte 256 a no-op, emit_symbols holding eight
+        slots per entry, and the block size decode_array splits payloads
+        into. Each kind is built the first time it is needed and cached per
+        root like the other tables.
+
+        '''
+
+        if np is None:
+            return None
+
+        if self._array_root is not self.root:
+            self._array_root = self.root
+            self._array_tables = {}
+
+        if kind not in self._array_tables:
+            tables = None
+            codebook = self.get_codebook()
+            if all(isinstance(symbol, str) and len(symbol) == 1 and ord(symbol) < 256 for symbol in codebook):
+                max_length = max(len(code) for code in codebook.values())
+                if kind == 'encode' and max_length <= 64:
+                    codes = np.zeros(257, dtype=np.uint64)
+                    lengths = np.zeros(257, dtype=np.int64)
+                    for symbol, code in codebook.items():
+                        codes[ord(symbol)] = int(code, 2) << (64 - len(code))
+                        lengths[ord(symbol)] = len(code)
+                    paired = max_length <= 32
+                    if paired:
+                        shifts = lengths[:256, None].astype(np.uint64)
+                        codes = (codes[:256, None] | (codes[None, :] >> shifts)).ravel()
+                        lengths = (lengths[:256, None] + lengths[None, :]).ravel()
+                    tables = (codes, lengths, paired)
+                elif kind == 'decode':
+                    emit, table_next = self._get_decode_table(8)
+                    num_states = len(emit) >> 8
+                    next_state = np.empty(num_states * 257, dtype=np.int32)
+                    emit_count = np.zeros(num_states * 257, dtype=np.uint8)
+                    emit_symbols = np.zeros(num_states * 257 * 8, dtype=np.uint8)
+                    for state in range(num_states):
+                        for byte in range(256):
+                            emitted = emit[(state << 8) | byte]
+                            next_state[state * 257 + byte] = table_next[(state << 8) | byte]
+                            emit_count[state * 257 + byte] = len(emitted)
+                            for slot, symbol in enumerate(emitted):
+                                emit_symbols[(state * 257 + byte) * 8 + slot] = ord(symbol)
+                        next_state[state * 257 + 256] = state
+                    # blocks a whole number of g bits long, g the gcd of the
+                    # code lengths, so codes all of one length (which never
+                    # resynchronize) start every block at the root
+                    g = math.gcd(*(len(code) for code in codebook.values()))
+                    m = g // math.gcd(g, 8)
+                    tables = (next_state, emit_count, emit_symbols, 256 - 256 % m)
+            self._array_tables[kind] = tables
+
+        return self._array_tables[kind]
+
+    # Encodes a batch of messages. Returns a list of 0s and 1s strings, or
+    # with `packed=True` one packed payload in the `encode_bytes` format plus
+    # an array of len(messages) + 1 bit offsets, message i being the bits
+    # from offsets[i] up to offsets[i + 1].
+    def encode_many(self, messages, packed=False):
+
+        '''
+
+        Encodes every message with the codebook fetched once, skipping the
+        per call overhead of encode().
+
+        '''
+
+        if self.stats is not None:
+            start = time.perf_counter()
+            messages = list(messages)
+            result = self._encode_many(messages, packed)
+            bits = result[1][-1] if packed else sum(len(bits) for bits in result)
+            self.stats.record('encode', sum(len(message) for message in messages), bits,
+                              time.perf_counter() - start)
+            return result
+
+        return self._encode_many(messages, packed)
+
+    def _encode_many(self, messages, packed):
+        lookup = self.get_codebook().get
+        join = ''.join
+        encoded = [join([lookup(char, '') for char in message]) for message in messages]
+
+        if not packed:
+            return encoded
+
+        offsets = array('Q', [0])
+        total = 0
+        for bits in encoded:
+            total += len(bits)
+            offsets.append(total)
+
+        payload, padding = _pack_bits(join(encoded))
+
+        return payload + bytes([padding]), offsets
+
+    # Decodes a batch made by `encode_many`: either a list of 0s and 1s
+    # strings, or a packed payload together with its `offsets`. Returns a
+    # list with None for each message that can't be decoded. Raises
+    # ValueError if a string holds anything but 0s and 1s.
+    def decode_many(self, encoded, offsets=None):
+
+        '''
+
+        Decodes every message with the lookup tables fetched once, reusing
+        one list for the symbols of each message.
+
+        '''
+
+        # any iterable of bit strings; it is read more than once
+        if offsets is None:
+            encoded = list(encoded)
+
+        if self.stats is not None:
+            start = time.perf_counter()
+            results = self._decode_many(encoded, offsets)
+            bits = offsets[-1] - offsets[0] if offsets is not None else sum(len(bits) for bits in encoded)
+            self.stats.record('decode', sum(len(decoded) for decoded in results if decoded is not None), bits,
+                              time.perf_counter() - start)
+            return results
+
+        return self._decode_many(encoded, offsets)
+
+    def _decode_many(self, encoded, offsets):
+        results = []
+        join = ''.join
+
+        if offsets is not None:
+            payload = memoryview(encoded).cast('B')
+            for i in range(len(offsets) - 1):
+                decoded, state = self._decode_packed(payload, offsets[i], offsets[i + 1])
+                results.append(join(decoded) if state == 0 else None)
+            return results
+
+        k, (emit, next_state) = self._table_for(self.decode_bits, sum(len(bits) for bits in encoded))
+        step_emit, step_next = self._get_decode_table(1)
+        decoded = []
+
+        for bits in encoded:
+            _check_bits(bits)
+            decoded.clear()
+            state = 0
+            msg_len = len(bits)
+            full_len = msg_len - msg_len % k
+
+            for i in range(0, full_len, k):
+                entry = (state << k) | int(bits[i:i + k], 2)
+                if emit[entry]:
+                    decoded.extend(emit[entry])
+                state = next_state[entry]
+
+            for bit in bits[full_len:]:
+                entry = (state << 1) | int(bit, 2)
+                if step_emit[entry]:
+                    decoded.extend(step_emit[entry])
+                state = step_next[entry]
+
+            results.append(join(decoded) if state == 0 else None)
+
+        return results
+
+    # Encodes `s` like `encode_bytes` and also returns a sparse sync index
+    # for random access: one `(bit_offset, symbol_offset)` entry for every
+    # `interval` symbols, starting with (0, 0).
+    def encode_indexed(self, s, interval=1024):
+
+        '''
+
+        Encodes s in pieces of `interval` symbols, noting where each piece
+        starts in the bit stream, then packs the whole thing at once.
+
+        '''
+
+        assert(s is not None)
+        assert(interval >= 1)
+
+        if self.stats is not None:
+            start = time.perf_counter()
+
+        pieces = []
+        index = []
+        bit_offset = 0
+
+        for symbol_offset in range(0, len(s), interval):
+            bits = self._encode(s[symbol_offset:symbol_offset + interval])
+            index.append((bit_offset, symbol_offset))
+            pieces.append(bits)
+            bit_offset += len(bits)
+
+        packed, padding = _pack_bits(''.join(pieces))
+
+        if self.stats is not None:
+            self.stats.record('encode', len(s), bit_offset, time.perf_counter() - start)
+
+        return packed + bytes([padding]), index
+
+    # Decodes `count` symbols starting at symbol `start_symbol` out of a
+    # payload made by `encode_indexed`, without touching anything before the
+    # nearest sync point. Like slicing, ranges past the end come back short.
+    def decode_range(self, payload, index, start_symbol, count):
+
+        '''
+
+        Seeks to the last sync point at or before start_symbol and decodes
+        from there up to the first sync point at or past the end of the
+        range, so the cost is bounded by the index interval plus count.
+
+        '''
+
+        assert(start_symbol >= 0 and count >= 0)
+
+        payload = memoryview(payload).cast('B')
+        if len(index) == 0 or count == 0:
+            return ''
+
+        total_bits = (len(payload) - 1) * 8 - payload[-1]
+        end_symbol = start_symbol + count
+
+        first = bisect.bisect_right(index, start_symbol, key=lambda entry: entry[1]) - 1
+        last = bisect.bisect_left(index, end_symbol, key=lambda entry: entry[1])
+
+        bit_start, symbol_offset = index[first]
+        bit_end = index[last][0] if last < len(index) else total_bits
+
+        decoded, _ = self._decode_packed(payload, bit_start, bit_end)
+        skip = start_symbol - symbol_offset
+
+        return ''.join(decoded[skip:skip + count])
+
+    # Process pool whose workers each get a copy of this tree once, when they
+    # start. Used by encode_parallel and decode_parallel, and the pool to
+    # pass as `executor` to the async coders for process offloading.
+    def worker_pool(self, max_workers=None):
+        return _WorkerPool(self, max_workers)
+
+    def _parallel_pool(self, max_workers):
+
+        '''
+
+        Returns the worker_pool encode_parallel and decode_parallel run on.
+        It is started on first use and kept, so later calls skip starting
+        processes and sending them the tree; it is replaced when asked for
+        another number of workers or once `self.root` has been replaced.
+
+        '''
+
+        pool = self._pool
+        if pool is None or pool.max_workers != max_workers or pool.root is not self.root:
+            if pool is not None:
+                pool.shutdown()
+            pool = self._pool = self.worker_pool(max_workers)
+
+        return pool
+
+    # Shuts down the worker processes encode_parallel and decode_parallel
+    # keep between calls, if any. The tree stays usable; the next parallel
+    # call starts a new pool. Trees also work as context managers that close
+    # on exit.
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Encodes `s` in blocks of `block_size` symbols spread over a process
+    # pool. Each block is packed on its own and padded to a whole byte, so
+    # any block can be decoded without the others. Returns the payload and an
+    # index with one `(bit_offset, symbol_count)` entry per block.
+    def encode_parallel(self, s, block_size=1 << 20, max_workers=None):
+
+        '''
+
+        Splits s into blocks and encodes them across worker processes. The
+        tree is sent to each worker once, when the worker starts, not with
+        every block.
+
+        '''
+
+        assert(s is not None)
+        assert(block_size >= 1)
+
+        if self.stats is not None:
+            start = time.perf_counter()
+
+        blocks = [s[i:i + block_size] for i in range(0, len(s), block_size)]
+
+        packed_blocks = list(self._parallel_pool(max_workers).map(_encode_block, blocks))
+
+        index = []
+        bit_offset = 0
+        for (packed, _), block in zip(packed_blocks, blocks):
+            index.append((bit_offset, len(block)))
+            bit_offset += len(packed) * 8
+
+        # the code bits, not the padding that ends each block
+        if self.stats is not None:
+            self.stats.record('encode', len(s), sum([bits for _, bits in packed_blocks]),
+                              time.perf_counter() - start)
+
+        return b''.join([packed for packed, _ in packed_blocks]), index
+
+    # Decodes a payload made by `encode_parallel` using its block index.
+    # Like decode_bytes, returns None if a block can't be decoded, e.g.
+    # because the payload is truncated or corrupt.
+    def decode_parallel(self, payload, index, max_workers=None):
+
+        '''
+
+        Cuts the payload into its blocks using the index, decodes them
+        across worker processes, and joins the results back in order.
+
+        '''
+
+        if self.stats is not None:
+            start = time.perf_counter()
+
+        payload = memoryview(payload).cast('B')
+
+        jobs = []
+        for i, (bit_offset, symbol_count) in enumerate(index):
+            end = index[i + 1][0] if i + 1 < len(index) else len(payload) * 8
+            jobs.append((bytes(payload[bit_offset >> 3:end >> 3]), symbol_count))
+
+        blocks = list(self._parallel_pool(max_workers).map(_decode_block, jobs))
+        decoded = None if None in blocks else ''.join([block for block, _ in blocks])
+
+        # the code bits, not the padding that ends each block
+        if self.stats is not None:
+            bits = 0 if decoded is None else sum([used_bits for _, used_bits in blocks])
+            self.stats.record('decode', 0 if decoded is None else len(decoded), bits,
+                              time.perf_counter() - start)
+
+        return decoded
+
+
+# Tree used by the block workers, installed once per worker process.
+_worker_tree = None
+
+# Process pool made by `HuffmanTree.worker_pool`, remembering the tree its
+# workers were started with, that tree's root at the time and the worker
+# count it was asked for.
+class _WorkerPool(ProcessPoolExecutor):
+    def __init__(self, tree, max_workers=None):
+        super().__init__(max_workers, initializer=_init_worker, initargs=(tree,))
+        self.tree = tree
+        self.root = tree.root
+        self.max_workers = max_workers
+
+def _init_worker(tree):
+    global _worker_tree
+    _worker_tree = tree
+
+# Packs one block, returning the bytes and the number of code bits in them.
+def _encode_block(block):
+    bits = _worker_tree._encode(block)
+    packed, _ = _pack_bits(bits)
+    return packed, len(bits)
+
+# Decodes one block into its symbols and the number of code bits they
+# took, or returns None if it doesn't hold `symbol_count` symbols ending in
+# its last byte.
+def _decode_block(job):
+    data, symbol_count = job
+    decoded, _ = _worker_tree._decode_packed(data, 0, len(data) * 8)
+    # the zero padding may decode into extra symbols past the end of the block
+    decoded = decoded[:symbol_count]
+
+    codebook = _worker_tree.get_codebook()
+    used_bits = sum([len(codebook[symbol]) for symbol in decoded])
+    if len(decoded) < symbol_count or used_bits <= (len(data) - 1) * 8:
+        return None
+
+    return ''.join(decoded), used_bits
+
+# The tree to send along with a job for `executor`: None for a worker_pool
+# of that same tree, whose processes already have their own copy.
+def _job_tree(tree, executor):
+    if isinstance(executor, _WorkerPool) and executor.tree is tree:
+        return None
+    return tree
+
+# One packed HuffmanEncoder/HuffmanDecoder step as a function of the coder's
+# state, so the async coders can run it in any executor. `tree` is None when
+# running in a worker_pool process, which already has its own copy.
+def _feed_encoder(tree, carry, chunk, final):
+    encoder = HuffmanEncoder(tree if tree is not None else _worker_tree, packed=True)
+    encoder._carry = carry
+    out = encoder.feed(chunk.decode('latin-1'))
+    if final:
+        out += encoder.flush()
+    return out, encoder._carry
+
+def _feed_decoder(tree, state, held, chunk, final):
+    decoder = HuffmanDecoder(tree if tree is not None else _worker_tree, packed=True)
+    decoder._state = state
+    decoder._held = held
+    out = decoder.feed(chunk)
+    if final:
+        rest = decoder.flush()
+        out = None if rest is None else out + rest
+    return out, decoder._state, decoder._held
+
+
+# LRU bounded cache of built trees for workloads that compress many small
+# messages with the same model. Trees are keyed by a model ID derived from
+# the `(symbol, weight)` list and the tree options that shape the codes, so
+# a message only needs to carry that ID, and each cached tree keeps the
+# codebook and the decode tables it builds as messages go through it.
+# `get` hashes the whole list on every call; callers sending many messages
+# should `register` the model once and look it up with `get_by_id`.
+# `tree_kwargs` are passed to every HuffmanTree the registry builds.
+class HuffmanModelRegistry:
+    def __init__(self, maxsize=128, **tree_kwargs):
+        assert(maxsize >= 1)
+        self.maxsize = maxsize
+        self.tree_kwargs = tree_kwargs
+        self._trees = collections.OrderedDict()  # model id -> tree, oldest first
+
+    def model_id(self, symbol_list):
+
+        '''
+
+        Returns a short stable ID for a symbol list under this registry's
+        tree options. The list is sorted first, since the order of the pairs
+        doesn't change the tree. The options that change the codes
+        (canonical and max_code_length) go into the ID too, so registries
+        that build different codes never hand out the same ID; both build
+        engines give the same tree, so build_engine doesn't.
+
+        '''
+
+        shape = (self.tree_kwargs.get('canonical', False),
+                 self.tree_kwargs.get('max_code_length'))
+        key = repr((sorted(symbol_list), shape)).encode('utf-8')
+        return hashlib.sha1(key).hexdigest()[:16]
+
+    def register(self, symbol_list):
+
+        '''
+
+        Makes sure the model for symbol_list is cached and returns its ID.
+
+        '''
+
+        model_id = self.model_id(symbol_list)
+        self._lookup(model_id, symbol_list)
+        return model_id
+
+    def get(self, symbol_list):
+
+        '''
+
+        Returns the tree for symbol_list, building it only on a cache miss.
+
+        '''
+
+        return self._lookup(self.model_id(symbol_list), symbol_list)
+
+    def get_by_id(self, model_id):
+
+        '''
+
+        Returns the cached tree for an ID from register(). Raises KeyError
+        if that model was never registered or has been evicted since.
+
+        '''
+
+        tree = self._trees[model_id]
+        self._trees.move_to_end(model_id)
+        return tree
+
+    def _lookup(self, model_id, symbol_list):
+        tree = self._trees.get(model_id)
+        if tree is not None:
+            self._trees.move_to_end(model_id)
+            return tree
+
+        tree = HuffmanTree(symbol_list, **self.tree_kwargs)
+
+        self._trees[model_id] = tree
+        # an evicted tree's worker processes go with it
+        if len(self._trees) > self.maxsize:
+            _, evicted = self._trees.popitem(last=False)
+            evicted.close()
+
+        return tree
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, model_id):
+        return model_id in self._trees
+
+# Incremental encoder for input that arrives in pieces. Each `feed(chunk)`
+# returns the output that is ready so far and `flush()` returns the rest, so
+# the concatenated output equals `tree.encode(...)` of the whole input, or
+# `tree.encode_bytes(...)` when `packed=True`.
+class HuffmanEncoder:
+    def __init__(self, tree, packed=False):
+        self.tree = tree
+        self.packed = packed
+        self._carry = ''  # packed mode: code bits that don't fill a byte yet
+
+    def feed(self, chunk):
+
+        '''
+
+        Encodes the next piece of the input. In packed mode only whole bytes
+        are returned; the odd bits wait for the next chunk.
+
+        '''
+
+        bits = self.tree.encode(chunk)
+        if not self.packed:
+            return bits
+
+        packed, self._carry = _pack_whole_bytes(self._carry + bits)
+        return packed
+
+    def flush(self):
+
+        '''
+
+        Finishes the stream. In packed mode this writes the last partial
+        byte and the padding trailer.
+
+        '''
+
+        if not self.packed:
+            return ''
+
+        packed, padding = _pack_bits(self._carry)
+        self._carry = ''
+
+        return packed + bytes([padding])
+
+
+# Incremental decoder, the counterpart of `HuffmanEncoder`. The position in
+# the tree is carried across `feed` calls, so codes may be split anywhere
+# between chunks. `flush()` returns None when the stream ends partway down
+# the tree, the same condition that makes `decode` return None.
+class HuffmanDecoder:
+    def __init__(self, tree, packed=False):
+        self.tree = tree
+        self.packed = packed
+        self._state = 0  # internal node the walk is at, 0 is the root
+        self._held = b''  # packed mode: last bytes, which may be the trailer
+
+    def feed(self, chunk):
+
+        '''
+
+        Decodes the next piece of the encoded stream and returns the symbols
+        completed so far. In packed mode the final two bytes seen are held
+        back, since they may be the padded last byte and the trailer.
+
+        '''
+
+        stats = self.tree.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        if not self.packed:
+            num_bits = len(chunk)
+            decoded, self._state = self.tree._decode_bits(chunk, self._state)
+        else:
+            data = self._held + bytes(chunk)
+            ready = max(len(data) - 2, 0)
+            self._held = data[ready:]
+
+            num_bits = ready * 8
+            decoded, self._state = self.tree._decode_packed(data, 0, num_bits, self._state)
+
+        if stats is not None:
+            stats.record('decode', len(decoded), num_bits, time.perf_counter() - start)
+
+        return ''.join(decoded)
+
+    def flush(self):
+
+        '''
+
+        Finishes the stream, returning the last symbols or None if the
+        stream can't be decoded. The decoder is reset for reuse either way.
+
+        '''
+
+        state = self._state
+        decoded = []
+
+        if self.packed:
+            held = self._held
+            num_bits = _trailer_bits(held)
+
+            stats = self.tree.stats
+            if stats is not None:
+                start = time.perf_counter()
+
+            decoded, state = self.tree._decode_packed(held, 0, num_bits, state)
+
+            if stats is not None:
+                stats.record('decode', len(decoded) if state == 0 else 0, num_bits, time.perf_counter() - start)
+
+        self._state = 0
+        self._held = b''
+
+        # have leftover bits so cant decode
+        if state != 0:
+            return None
+
+        return ''.join(decoded)
+
+
+
+# asyncio counterparts of the packed HuffmanEncoder and HuffmanDecoder, for
+# services that can't block the event loop. Each reads `chunk_size` bytes at
+# a time from an asyncio.StreamReader and is used with `async for`, yielding
+# output blocks until the reader hits EOF. The coding runs in `executor`:
+# the loop's default thread pool when None, or any other executor. A pool
+# from `tree.worker_pool()` is the one to use for other processes, since its
+# workers already hold the tree; any other pool gets the tree sent along
+# with every chunk. Only one chunk is read ahead of the consumer, so a slow
+# consumer, e.g. one awaiting `writer.drain()` as `compress_stream` does,
+# holds back reading too. Byte streams map to the symbols chr(0)..chr(255)
+# as in the command line tool, so trees come from `from_data` on bytes.
+class AsyncHuffmanEncoder:
+    def __init__(self, tree, reader, chunk_size=1 << 20, executor=None):
+        assert(chunk_size >= 1)
+        self.tree = tree
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self._carry = ''
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+
+        '''
+
+        Reads and encodes the next chunk. The block after the last chunk
+        also holds the final partial byte and the padding trailer.
+
+        '''
+
+        if self._done:
+            raise StopAsyncIteration
+
+        chunk = await self.reader.read(self.chunk_size)
+        final = len(chunk) == 0
+        tree = _job_tree(self.tree, self.executor)
+
+        loop = asyncio.get_running_loop()
+        out, self._carry = await loop.run_in_executor(
+            self.executor, _feed_encoder, tree, self._carry, chunk, final)
+
+        self._done = final
+        return out
+
+
+class AsyncHuffmanDecoder:
+    def __init__(self, tree, reader, chunk_size=1 << 20, executor=None):
+        assert(chunk_size >= 1)
+        self.tree = tree
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self._state = 0
+        self._held = b''
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+
+        '''
+
+        Reads and decodes the next chunk, yielding a string of symbols.
+        Raises ValueError if the stream ends partway through a code.
+
+        '''
+
+        if self._done:
+            raise StopAsyncIteration
+
+        chunk = await self.reader.read(self.chunk_size)
+        final = len(chunk) == 0
+        tree = _job_tree(self.tree, self.executor)
+
+        loop = asyncio.get_running_loop()
+        out, self._state, self._held = await loop.run_in_executor(
+            self.executor, _feed_decoder, tree, self._state, self._held, chunk, final)
+
+        self._done = final
+        if out is None:
+            raise ValueError("stream ends partway through a code")
+        return out
+
+
+# Encodes everything from `reader` into `writer` in the `encode_bytes`
+# format, waiting on `writer.drain()` after every block so a slow peer
+# throttles the encoder instead of filling the write buffer.
+async def compress_stream(tree, reader, writer, chunk_size=1 << 20, executor=None):
+    async for block in AsyncHuffmanEncoder(tree, reader, chunk_size, executor):
+        writer.write(block)
+        await writer.drain()
+
+# The reverse of `compress_stream`, writing the decoded bytes.
+async def decompress_stream(tree, reader, writer, chunk_size=1 << 20, executor=None):
+    async for text in AsyncHuffmanDecoder(tree, reader, chunk_size, executor):
+        writer.write(text.encode('latin-1'))
+        await writer.drain()
+
+
+
+# State shared by the adaptive coders: an FGK dynamic Huffman tree that starts
+# out as the single NYT ("not yet transmitted") leaf and is updated after
+# every symbol. `nodes` lists the nodes from the highest FGK number down, so
+# weights never increase along it, the root is first and the NYT leaf last;
+# `order` is a node's index in it. Nodes of equal weight form one run of
+# `nodes`, and `leaders` maps each weight above 0 to the index its run starts
+# at, the highest numbered node of that weight.
+class _AdaptiveHuffmanModel:
+    class Node:
+        __slots__ = ('weight', 'parent', 'left', 'right', 'symbol', 'order')
+
+        def __init__ (self, symbol=None):
+            self.weight = 0
+            self.parent = None
+            self.left = None
+            self.right = None
+            self.symbol = symbol
+            self.order = 0
+
+    def __init__(self, symbol_bits):
+        assert(symbol_bits >= 1)
+        self.symbol_bits = symbol_bits
+        self.nyt = self.Node()
+        self.root = self.nyt
+        self.nodes = [self.nyt]
+        self.leaders = {}  # weight -> index of its highest numbered node
+        self.leaves = {}  # symbol -> leaf node
+
+    def check(self, symbols):
+        # raises ValueError for the first symbol whose code point doesn't
+        # fit in `symbol_bits` bits
+        for symbol in symbols:
+            if ord(symbol) >> self.symbol_bits:
+                raise ValueError("symbol %r doesn't fit in %d bits" % (symbol, self.symbol_bits))
+
+    def code(self, symbol):
+
+        '''
+
+        Returns the bits for symbol under the current tree. A symbol not seen
+        before is the NYT code followed by the symbol's code point in
+        `symbol_bits` bits.
+
+        '''
+
+        node = self.leaves.get(symbol)
+        is_new = node is None
+        if is_new:
+            self.check(symbol)
+            node = self.nyt
+
+        path = []
+        while node.parent is not None:
+            path.append('1' if node.parent.right is node else '0')
+            node = node.parent
+        path.reverse()
+
+        if is_new:
+            path.append(format(ord(symbol), '0%db' % self.symbol_bits))
+
+        return ''.join(path)
+
+    def update(self, symbol):
+
+        '''
+
+        Counts one more symbol. A new symbol splits the NYT leaf into a new
+        NYT and the symbol's leaf. Then, from the leaf up to the root, each
+        node is swapped with the highest numbered node of the same weight
+        before its weight goes up, which keeps the sibling property. Both
+        steps are O(1) per node on the path.
+
+        '''
+
+        nodes = self.nodes
+        leaders = self.leaders
+        node = self.leaves.get(symbol)
+
+        if node is None:
+            parent = self.nyt
+            new_nyt = self.Node()
+            node = self.Node(symbol)
+            parent.left = new_nyt
+            parent.right = node
+            new_nyt.parent = parent
+            node.parent = parent
+
+            # the old NYT had the lowest number, the new pair goes below it
+            node.order = len(nodes)
+            new_nyt.order = len(nodes) + 1
+            nodes.append(node)
+            nodes.append(new_nyt)
+
+            self.nyt = new_nyt
+            self.leaves[symbol] = node
+
+        while node is not None:
+            weight = node.weight
+
+            # weight 0 is only the new leaf, whose leader is its parent (the
+            # old NYT), and that parent, which leads itself
+            leader = leaders.get(weight, node.order)
+            if leader != node.order and nodes[leader] is not node.parent:
+                self._swap(node, nodes[leader])
+
+            # node is now first in its run, or right behind its parent when
+            # that led; either way it moves to the end of the next run up
+            index = node.order
+            node.weight = weight + 1
+            if leaders.get(weight + 1, index + 1) > index:
+                leaders[weight + 1] = index
+            if leaders.get(weight) == index:
+                if nodes[index + 1].weight == weight:
+                    leaders[weight] = index + 1
+                else:
+                    del leaders[weight]
+
+            node = node.parent
+
+    def _swap(self, a, b):
+        # swap two subtrees in the tree and their places in `nodes`
+        a_parent = a.parent
+        b_parent = b.parent
+
+        if a_parent is b_parent:
+            a_parent.left, a_parent.right = a_parent.right, a_parent.left
+        else:
+            if a_parent.left is a:
+                a_parent.left = b
+            else:
+                a_parent.right = b
+            if b_parent.left is b:
+                b_parent.left = a
+            else:
+                b_parent.right = a
+            a.parent, b.parent = b_parent, a_parent
+
+        self.nodes[a.order], self.nodes[b.order] = b, a
+        a.order, b.order = b.order, a.order
+
+
+# Single pass adaptive (FGK) Huffman encoder. No weights are needed up front
+# and no header is sent: the tree learns the distribution as symbols go by,
+# and `AdaptiveHuffmanDecoder` rebuilds the same tree from the bits alone.
+# Symbols are characters whose code points fit in `symbol_bits` bits (8 for
+# bytes read as latin-1, 21 for any unicode character). Output is a string
+# of 0s and 1s like `HuffmanTree.encode`, or with `packed=True` bytes in the
+# `encode_bytes` format, whose padding trailer marks where the stream ends
+# so it can be sent over a byte stream as is.
+class AdaptiveHuffmanEncoder:
+    def __init__(self, symbol_bits=8, packed=False):
+        self._model = _AdaptiveHuffmanModel(symbol_bits)
+        self.packed = packed
+        self._carry = ''  # packed mode: code bits that don't fill a byte yet
+
+    def feed(self, chunk):
+
+        '''
+
+        Encodes the next piece of the input, updating the tree after each
+        symbol. In packed mode only whole bytes are returned; the odd bits
+        wait for the next chunk. Raises ValueError, with the tree untouched,
+        if any symbol of the chunk doesn't fit in `symbol_bits` bits.
+
+        '''
+
+        model = self._model
+        # checked up front, so a refused chunk leaves no updates behind
+        if not isinstance(chunk, str):
+            chunk = list(chunk)
+        model.check(chunk)
+
+        encoded = [self._carry] if self.packed else []
+        for symbol in chunk:
+            encoded.append(model.code(symbol))
+            model.update(symbol)
+
+        bits = ''.join(encoded)
+        if not self.packed:
+            return bits
+
+        packed, self._carry = _pack_whole_bytes(bits)
+        return packed
+
+    def flush(self):
+
+        '''
+
+        Finishes the stream. In packed mode this writes the last partial
+        byte and the padding trailer. The encoder starts the next stream
+        with an empty tree, like AdaptiveHuffmanDecoder after its flush.
+
+        '''
+
+        self._model = _AdaptiveHuffmanModel(self._model.symbol_bits)
+        if not self.packed:
+            return ''
+
+        packed, padding = _pack_bits(self._carry)
+        self._carry = ''
+
+        return packed + bytes([padding])
+
+
+# Decoder for `AdaptiveHuffmanEncoder` output, mirroring the encoder's tree
+# update for update. Chunks may split codes anywhere; `flush()` returns None
+# if the stream stops partway through a code, like `HuffmanDecoder`. With
+# `packed=True` it reads the encoder's packed output, holding back the last
+# two bytes seen like `HuffmanDecoder` does, so the padding bits before the
+# trailer are never decoded as symbols.
+class AdaptiveHuffmanDecoder:
+    def __init__(self, symbol_bits=8, packed=False):
+        self._model = _AdaptiveHuffmanModel(symbol_bits)
+        self.packed = packed
+        self._held = b''  # packed mode: last bytes, which may be the trailer
+        self._node = self._model.root
+        self._raw_bits = -1  # bits of a new symbol read so far, -1 when not reading one
+        self._raw_value = 0
+        self._restart()
+
+    def _restart(self):
+        # back to the root; an empty tree is all NYT, so read a new symbol
+        self._node = self._model.root
+        if self._node is self._model.nyt:
+            self._raw_bits = 0
+            self._raw_value = 0
+
+    def feed(self, chunk):
+
+        '''
+
+        Decodes the next piece of the stream and returns the symbols
+        completed so far. In packed mode the final two bytes seen are held
+        back, since they may be the padded last byte and the trailer.
+
+        '''
+
+        if not self.packed:
+            return self._decode_bits(chunk)
+
+        data = self._held + bytes(chunk)
+        ready = max(len(data) - 2, 0)
+        self._held = data[ready:]
+
+        return self._decode_bits(_bytes_to_bits(data[:ready], ready * 8))
+
+    def _decode_bits(self, bits):
+        model = self._model
+        symbol_bits = model.symbol_bits
+        decoded = []
+
+        for bit in bits:
+            bit = int(bit, 2)
+
+            # reading the code point of a symbol not seen before
+            if self._raw_bits >= 0:
+                self._raw_value = (self._raw_value << 1) | bit
+                self._raw_bits += 1
+                if self._raw_bits == symbol_bits:
+                    symbol = chr(self._raw_value)
+                    self._raw_bits = -1
+                    decoded.append(symbol)
+                    model.update(symbol)
+                    self._restart()
+                continue
+
+            node = self._node.right if bit else self._node.left
+
+            if node is model.nyt:
+                self._node = node
+                self._raw_bits = 0
+                self._raw_value = 0
+            elif node.symbol is not None:
+                decoded.append(node.symbol)
+                model.update(node.symbol)
+                self._restart()
+            else:
+                self._node = node
+
+        return ''.join(decoded)
+
+    def flush(self):
+
+        '''
+
+        Finishes the stream, returning the last symbols ('' in bit string
+        mode) or None if it stopped partway through a code. The decoder is
+        reset either way, back to an empty tree for the next stream.
+
+        '''
+
+        decoded = ''
+
+        if self.packed:
+            held = self._held
+            decoded = self._decode_bits(_bytes_to_bits(held[:-1], _trailer_bits(held)))
+
+        # stopped partway down the tree, right after the NYT escape or
+        # partway through a code point
+        if self._raw_bits > 0 or self._node is not self._model.root:
+            decoded = None
+
+        self._model = _AdaptiveHuffmanModel(self._model.symbol_bits)
+        self._held = b''
+        self._raw_bits = -1
+        self._restart()
+
+        return decoded
+
+# The first num_bits bits of data as a string of 0s and 1s.
+def _bytes_to_bits(data, num_bits):
+    if num_bits <= 0:
+        return ''
+    return format(int.from_bytes(data, 'big'), '0%db' % (len(data) * 8))[:num_bits]
+
+
+# Command line entry point, run as `python -m huffman`:
+#
+#   python -m huffman compress INPUT OUTPUT
+#   python -m huffman decompress INPUT OUTPUT
+#   python -m huffman stats INPUT
+#
+# Files are treated as bytes. A compressed file is the magic bytes, the
+# canonical code length header and then the packed payload in the
+# `encode_bytes` format. Inputs are memory mapped and processed in chunks,
+# so neither side ever holds the whole file as a Python string.
+
+MAGIC = b'HUF1'
+CHUNK_SIZE = 1 << 20
+
+# Maps a file for reading; empty files can't be mapped so they come back as b''.
+def _map_file(f):
+    if f.seek(0, 2) == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _tree_for(counts):
+    # an empty file still needs a tree to write a header for
+    if len(counts) == 0:
+        counts = {'\x00': 0, '\x01': 0}
+    return HuffmanTree.from_data(counts, canonical=True)
+
+# Writes OUTPUT through `write(dst)` into a temporary file in the same
+# directory, then moves it into place, so a failure (or an input that turns
+# out to be bad) never leaves OUTPUT truncated. The input and output must
+# be different files, since the output replaces the file being read.
+def _write_output(input_path, output_path, write):
+    if os.path.exists(output_path) and os.path.samefile(input_path, output_path):
+        raise ValueError("input and output are the same file: %s" % output_path)
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), prefix='.huffman-')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            write(dst)
+        shutil.copymode(input_path, temp_path)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def _compress(input_path, output_path):
+    with open(input_path, 'rb') as src:
+        data = _map_file(src)
+
+        def write(dst):
+            tree = _tree_for(count_symbols(data))
+
+            dst.write(MAGIC)
+            dst.write(tree.serialize_header())
+
+            encoder = HuffmanEncoder(tree, packed=True)
+            for i in range(0, len(data), CHUNK_SIZE):
+                dst.write(encoder.feed(data[i:i + CHUNK_SIZE].decode('latin-1')))
+            dst.write(encoder.flush())
+
+        try:
+            _write_output(input_path, output_path, write)
+        finally:
+            if len(data):
+                data.close()
+
+def _decompress(input_path, output_path):
+    with open(input_path, 'rb') as src:
+        data = _map_file(src)
+
+        def write(dst):
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a compressed file" % input_path)
+
+            with memoryview(data) as view:
+                _, payload_start = _read_header(view, len(MAGIC))
+                tree = HuffmanTree.from_header(view[len(MAGIC):])
+
+                decoder = HuffmanDecoder(tree, packed=True)
+                for i in range(payload_start, len(view), CHUNK_SIZE):
+                    dst.write(decoder.feed(view[i:i + CHUNK_SIZE]).encode('latin-1'))
+                rest = decoder.flush()
+
+            if rest is None:
+                raise ValueError("%s is corrupt: payload ends partway through a code" % input_path)
+            dst.write(rest.encode('latin-1'))
+
+        try:
+            _write_output(input_path, output_path, write)
+        finally:
+            if len(data):
+                data.close()
+
+def _stats(input_path, out):
+    with open(input_path, 'rb') as src:
+        data = _map_file(src)
+        counts = count_symbols(data)
+        size = len(data)
+        if size:
+            data.close()
+
+    print("input bytes:        %d" % size, file=out)
+    print("distinct symbols:   %d" % len(counts), file=out)
+    if size == 0:
+        return
+
+    stats = HuffmanStats()
+    tree = HuffmanTree.from_data(counts, canonical=True, stats=stats)
+    payload_bits = round(stats.average_code_length * size)
+    compressed = len(MAGIC) + len(tree.serialize_header()) + (payload_bits + 7) // 8 + 1
+
+    print("entropy:            %.4f bits/symbol" % stats.entropy, file=out)
+    print("average code:       %.4f bits/symbol" % stats.average_code_length, file=out)
+    print("compressed bytes:   %d" % compressed, file=out)
+    print("ratio:              %.4f" % (compressed / size), file=out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m huffman', description="Huffman compress files.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compress = commands.add_parser('compress', help="compress INPUT into OUTPUT")
+    compress.add_argument('input')
+    compress.add_argument('output')
+
+    decompress = commands.add_parser('decompress', help="decompress INPUT into OUTPUT")
+    decompress.add_argument('input')
+    decompress.add_argument('output')
+
+    stats = commands.add_parser('stats', help="report symbol statistics for INPUT")
+    stats.add_argument('input')
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'compress':
+            _compress(args.input, args.output)
+        elif args.command == 'decompress':
+            _decompress(args.input, args.output)
+        else:
+            _stats(args.input, sys.stdout)
+    except (OSError, ValueError) as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+
+    return 0
+
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,12 @@
-from boyer_moore import BoyerMooreMajority
+import collections
+import mmap
+import os
+import random
+import tempfile
+
+import boyer_moore
+from boyer_moore import BoyerMooreMajority, MisraGries, WindowedMajority, DecayedMajority, verified_majority
+from boyer_moore import parallel_majority
 
 if __name__ == "__main__":
   f = open("testcases_boyer_moore.txt", 'r')
@@ -15,9 +23,115 @@ if __name__ == "__main__":
       assert(bmm.counter == expected_counter)
       if expected_counter > 0:
         assert(bmm.guess == expected_guess or (bmm.guess == None and expected_guess=='!'))
+      bulk = BoyerMooreMajority.from_iterable(symbols)
+      assert(bulk.counter == bmm.counter and bulk.guess == bmm.guess)
+      mg = MisraGries(2).add_many(symbols)
+      assert(mg.counter == bmm.counter and mg.guess == bmm.guess)
+      if boyer_moore.np is not None:
+        # the same stream as an integer array, one code per distinct symbol
+        distinct, codes = boyer_moore.np.unique(symbols, return_inverse=True)
+        packed = BoyerMooreMajority.from_iterable(codes)
+        assert(packed.counter == bmm.counter)
+        if packed.counter > 0: assert(distinct[packed.guess] == bmm.guess)
+      # two halves merged agree with the whole stream on a true majority
+      half = len(symbols) // 2
+      merged = BoyerMooreMajority.from_iterable(symbols[:half])
+      merged.merge(BoyerMooreMajority.from_iterable(symbols[half:]))
+      if symbols.count(bmm.guess) * 2 > len(symbols):
+        assert(merged.guess == bmm.guess)
+        assert(verified_majority(symbols) == bmm.guess)
+      else:
+        assert(verified_majority(symbols) is None)
+      # a window as long as the stream sees all of it; a short one only the tail
+      whole = WindowedMajority(max(len(symbols), 1))
+      tail = WindowedMajority(3)
+      for s in symbols:
+        whole.add_next_element(s)
+        tail.add_next_element(s)
+      assert(whole.get_majority() == verified_majority(symbols))
+      assert(tail.get_majority() == verified_majority(symbols[-3:]))
     except:
       print("Test failure: %s"%test_name)
       break
     num_tests += 1
   f.close()
+
+  # Misra-Gries against exact counts: every element above total / k is a
+  # candidate, no counter overcounts or undercounts by more than total / k,
+  # weighted updates match the repeated elements they stand for, and merged
+  # halves keep the same guarantees for the whole stream
+  rng = random.Random(7)
+  symbols = "abcdefghij"
+  for k in (3, 5, 8):
+    stream = rng.choices(symbols, weights=[40, 20, 10, 8, 6, 5, 4, 3, 2, 2], k=2000)
+    pairs = [(s, rng.randint(1, 9)) for s in rng.choices(symbols, weights=[30, 25, 5, 5, 5, 5, 5, 5, 5, 10], k=500)]
+    exact = collections.Counter(stream)
+    weighted_exact = collections.Counter()
+    for s, w in pairs: weighted_exact[s] += w
+
+    halves = [MisraGries(k).add_many(stream[:700]), MisraGries(k).add_many(stream[700:])]
+    weighted = MisraGries(k)
+    for s, w in pairs: weighted.add_next_element(s, w)
+    repeated = MisraGries(k).add_many([s for s, w in pairs for _ in range(w)])
+    assert(weighted.counters == repeated.counters and weighted.total == repeated.total)
+
+    for mg, counts, source in ((MisraGries(k).add_many(stream), exact, stream), (halves[0].merge(halves[1]), exact, stream),
+                               (weighted, weighted_exact, pairs)):
+      total = sum(counts.values())
+      assert(mg.total == total and len(mg.counters) <= k - 1)
+      heavy = {s: c for s, c in counts.items() if c * k > total}
+      assert(set(heavy) <= set(mg.counters))
+      for s, c in mg.heavy_hitters():
+        assert(counts[s] - total / k <= c <= counts[s])
+      assert(mg.verify(source, weighted=source is pairs) == heavy)
+
+  # with k=2 a weighted element counts like that many repeats in Boyer-Moore
+  mg = MisraGries(2)
+  for s, w in pairs: mg.add_next_element(s, w)
+  bmm = BoyerMooreMajority.from_iterable([s for s, w in pairs for _ in range(w)])
+  assert(mg.guess == bmm.guess and mg.counter == bmm.counter)
+
+  # verified_majority over every kind of source: a file path, bytes and an
+  # mmap (in chunks smaller than the data), a callable and an empty file
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "stream")
+    for data, expected in ((b"abacaba" * 300, ord("a")), (b"abcabc" * 300, None), (b"", None)):
+      with open(path, 'wb') as out: out.write(data)
+      assert(verified_majority(path, chunk_size=100) == expected)
+      assert(verified_majority(data, chunk_size=100) == expected)
+      assert(verified_majority(lambda: iter(data)) == expected)
+      if data:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+          assert(verified_majority(mapped, chunk_size=100) == expected)
+  try:
+    verified_majority(iter([1, 1]))
+    assert(False)
+  except TypeError:
+    pass
+
+  # shards counted in a process pool and merged; shards may be empty
+  shards = [["a", "b", "a"], [], ["c", "a"], ["a", "a", "b", "c"], ["a"]]
+  merged = parallel_majority(shards, max_workers=2)
+  assert(merged.guess == "a" and merged.counter > 0)
+  assert(parallel_majority([[], []], max_workers=2).counter == 0)
+  assert(parallel_majority([]).guess is None)
+
+  # decayed votes follow a shift in the recent stream that plain
+  # Boyer-Moore, counting all of history, doesn't
+  stream = ["a"] * 20 + ["b"] * 10
+  decayed = DecayedMajority(half_life=4)
+  for s in stream: decayed.add_next_element(s)
+  assert(decayed.get_majority() == "b" and BoyerMooreMajority.from_iterable(stream).guess == "a")
+
+  # with timestamps the decay goes by time, not by elements: after a long
+  # gap one vote is enough to take over, without one it isn't
+  by_count = DecayedMajority(half_life=10)
+  by_time = DecayedMajority(half_life=10)
+  for t in range(10):
+    by_count.add_next_element("a")
+    by_time.add_next_element("a", timestamp=t)
+  by_count.add_next_element("b")
+  by_time.add_next_element("b", timestamp=1000)
+  assert(by_count.get_majority() == "a" and by_time.get_majority() == "b")
+  assert(abs(by_time.counter - 1) < 1e-6)
 print("Ran %d tests "%num_tests)
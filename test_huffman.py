@@ -1,4 +1,17 @@
-from huffman import HuffmanTree
+import asyncio
+import contextlib
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+import huffman
+from huffman import HuffmanTree, HuffmanDecoder, HuffmanStats, AsyncHuffmanEncoder, AsyncHuffmanDecoder
+from huffman import AdaptiveHuffmanEncoder, AdaptiveHuffmanDecoder, HuffmanModelRegistry, count_symbols
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 # This helper function takes a binary tree, and encodes it a string,
 # using parentheses. For example, this tree:
@@ -12,8 +25,17 @@ from huffman import HuffmanTree
 # Is parenthesized as ((AB)Z).
 
 def BinaryTreeToString(root):
-  if root.symbol is not None: return root.symbol
-  else: return "(%s%s)"%(BinaryTreeToString(root.left), BinaryTreeToString(root.right))
+  # walks an explicit stack so trees of any depth work; ')' closes a node
+  parts = []
+  stack = [root]
+  while stack:
+    node = stack.pop()
+    if isinstance(node, str): parts.append(node)
+    elif node.symbol is not None: parts.append(node.symbol)
+    else:
+      parts.append('(')
+      stack.extend((')', node.right, node.left))
+  return ''.join(parts)
 
 if __name__ == "__main__":
   f = open("testcases_huffman.txt", 'r')
@@ -27,11 +49,316 @@ if __name__ == "__main__":
     try:
       h = HuffmanTree(list(zip(symbols, weights)))
       assert(BinaryTreeToString(h.root) == tree)
+      assert(BinaryTreeToString(HuffmanTree(list(zip(symbols, weights)), build_engine='two_queue').root) == tree)
+      a = HuffmanTree(list(zip(symbols, weights)), compact=True)
+      assert(BinaryTreeToString(a.root) == tree)
+      assert(a.decode(decode_input) == decode_output)
       assert(h.encode(encode_input) == encode_output)
       assert(h.decode(decode_input) == decode_output)
+      assert(h.decode_bytes(h.encode_bytes(encode_input)) == encode_input)
+      c = HuffmanTree(list(zip(symbols, weights)), canonical=True)
+      assert(c.code_lengths() == h.code_lengths())
+      r = HuffmanTree.from_header(c.serialize_header())
+      assert(r.decode(c.encode(encode_input)) == encode_input)
+      l = HuffmanTree(list(zip(symbols, weights)), max_code_length=6)
+      assert(max(length for _, length in l.code_lengths()) <= 6)
+      assert(l.decode(l.encode(encode_input)) == encode_input)
+      payload, index = h.encode_indexed(encode_input, interval=2)
+      assert(h.decode_range(payload, index, 1, 3) == encode_input[1:4])
+      d = HuffmanDecoder(h)
+      half = len(decode_input) // 2
+      streamed = [d.feed(decode_input[:half]), d.feed(decode_input[half:]), d.flush()]
+      assert((None if streamed[-1] is None else ''.join(streamed)) == decode_output)
+      stats = HuffmanStats()
+      s = HuffmanTree(list(zip(symbols, weights)), stats=stats)
+      assert(s.encode(encode_input) == encode_output)
+      assert(stats.symbols['encode'] == len(encode_input) and stats.bits['encode'] == len(encode_output))
+      assert(sum(stats.depth_histogram.values()) == len(symbols))
+      assert(stats.entropy <= stats.average_code_length + 1e-9)
     except:
       print("Failed test %s"%testname)
       break
     num_tests += 1
   print("Ran %d tests"%num_tests)
   f.close()
+
+  # Fibonacci weights give a tree as deep as it gets, here 10^4 levels,
+  # well past the recursion limit
+  weights = [1, 1]
+  while len(weights) < 10001: weights.append(weights[-1] + weights[-2])
+  symbols = ["s%d"%i for i in range(len(weights))]
+  h = HuffmanTree(list(zip(symbols, weights)))
+  assert(BinaryTreeToString(h.root).startswith("(s10000(s9999(s9998"))
+  assert(h._encode_helper(h.root, "s0", "") == h.encode(["s0"]))
+  assert(h.decode(h.encode(["s0", "s10000", "s1"])) == "s0s10000s1")
+
+  # headers hold symbols as UTF-8, so other symbols are refused
+  for tree in (HuffmanTree([(1, 3), (2, 5)], canonical=True), HuffmanTree([("a", 3), ("b", 5)])):
+    try:
+      tree.serialize_header()
+      assert(False)
+    except ValueError:
+      pass
+
+  # async coders over a StreamReader, in chunks that split codes and bytes
+  async def roundtrip(tree, data, chunk_size, executor=None):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    packed = b''.join([block async for block in AsyncHuffmanEncoder(tree, reader, chunk_size, executor)])
+    assert(packed == tree.encode_bytes(data.decode('latin-1')))
+    reader = asyncio.StreamReader()
+    reader.feed_data(packed)
+    reader.feed_eof()
+    return ''.join([text async for text in AsyncHuffmanDecoder(tree, reader, chunk_size, executor)])
+  data = b"abracadabra" * 100
+  h = HuffmanTree.from_data(data)
+  assert(asyncio.run(roundtrip(h, data, 7)) == data.decode('latin-1'))
+  # in processes: the tree's own worker pool, and a plain pool it is sent to
+  with h.worker_pool(2) as pool:
+    assert(asyncio.run(roundtrip(h, data, 300, pool)) == data.decode('latin-1'))
+  with ProcessPoolExecutor(2) as pool:
+    assert(asyncio.run(roundtrip(h, data, 300, pool)) == data.decode('latin-1'))
+
+  # numpy engine, or its encode_bytes/decode_bytes fallback: skewed codes
+  # resynchronize between blocks, eight equal 3-bit codes never do and get
+  # blocks a multiple of 3 bytes long instead; codes over 32 bits are packed
+  # one byte at a time rather than in pairs
+  rng = random.Random(1)
+  fibonacci = [1, 1]
+  while len(fibonacci) < 40: fibonacci.append(fibonacci[-1] + fibonacci[-2])
+  for alphabet, weights in ((b"abcdefgh", None), (bytes(range(256)), range(1, 257)), (bytes(range(40)), fibonacci)):
+    data = bytes(rng.choices(alphabet, weights=weights, k=20000))
+    model = data if weights is None else {chr(symbol): weight for symbol, weight in zip(alphabet, weights)}
+    h = HuffmanTree.from_data(model, stats=HuffmanStats())
+    assert(h.encode_array(data) == h.encode_bytes(data.decode('latin-1')))
+    assert(h.decode_array(h.encode_array(data)) == data)
+    assert(h.stats.symbols['encode'] == 3 * len(data) and h.stats.symbols['decode'] == len(data))
+  # blocks that don't line up with such a code: one redo shows it, and
+  # later payloads skip the blocks
+  if huffman.np is not None:
+    data = bytes(rng.choices(b"abcdefgh", k=20000))
+    h = HuffmanTree.from_data(data)
+    h._array_tables['decode'] = h._get_array_tables('decode')[:3] + (256,)
+    assert(h.decode_array(h.encode_array(data)) == data and h._array_tables['decode'][3] == 0)
+    assert(h.decode_array(h.encode_array(data)) == data)
+  # arrays must hold byte values: wider integers in range are fine, values
+  # out of range or floats are refused rather than wrapped or truncated
+  if huffman.np is not None:
+    np = huffman.np
+    assert(h.encode_array(np.frombuffer(data, dtype=np.uint8).astype(np.int64)) == h.encode_array(data))
+    for bad in (np.array([300, 65, 44]), np.array([-1, 65]), np.array([65.5])):
+      try:
+        h.encode_array(bad)
+        assert(False)
+      except ValueError:
+        pass
+
+  # model registry: the pair order doesn't matter, and least recently
+  # used models are evicted past maxsize
+  registry = HuffmanModelRegistry(maxsize=2)
+  model = [("a", 5), ("b", 2), ("c", 1)]
+  first = registry.get(model)
+  assert(registry.get(model[::-1]) is first)
+  model_id = registry.register(model)
+  assert(registry.get_by_id(model_id) is first and model_id in registry)
+  other_id = registry.register([("x", 1), ("y", 1)])
+  registry.get_by_id(model_id)
+  registry.register([("p", 1), ("q", 2)])
+  assert(len(registry) == 2 and model_id in registry and other_id not in registry)
+  try:
+    registry.get_by_id(other_id)
+    assert(False)
+  except KeyError:
+    pass
+  # the ID covers the options that change the codes, but not the others
+  model = [(symbol, 1 << i) for i, symbol in enumerate("abcdefgh")]
+  model_ids = [HuffmanModelRegistry(**kwargs).register(model) for kwargs in ({}, {"max_code_length": 3}, {"canonical": True},
+                                                                             {"decode_bits": 4}, {"build_engine": "two_queue"})]
+  assert(len(set(model_ids[:3])) == 3 and model_ids[3] == model_ids[4] == model_ids[0])
+  # a list changed in place gets the tree for its new weights; cached trees
+  # build no decode tables until they decode something
+  registry = HuffmanModelRegistry()
+  model = [("a", 50), ("b", 1), ("c", 1)]
+  tree = registry.get(model)
+  model[0] = ("a", 1)
+  model[2] = ("c", 50)
+  assert(registry.get(model).encode("c") == "1" and tree.encode("c") != "1")
+  assert(tree._decode_tables == {})
+
+  # bit strings are 0s and 1s only: int(chunk, 2) would read the ones
+  # with spaces, '_' or '0b' as other bits, so all of them are refused
+  bits = first.encode("abcabcab")
+  for bad in (" " + bits[1:], bits[:4] + "_" + bits[5:], "0b" + bits[2:], bits[:-1] + "2"):
+    for decode in (first.decode, lambda bad: first.decode_many([bad]), HuffmanDecoder(first).feed):
+      try:
+        decode(bad)
+        assert(False)
+      except ValueError:
+        pass
+
+  # batches, as strings and packed, with empty messages; a message that
+  # stops partway down the tree comes back as None
+  messages = ["abc", "", "cab" * 20, "a"]
+  encoded = first.encode_many(messages)
+  assert(encoded == [first.encode(message) for message in messages])
+  assert(first.decode_many(encoded) == messages)
+  assert(first.decode_many(bits for bits in encoded) == messages)
+  assert(first.decode_many(encoded + [first.encode("b")[:-1]]) == messages + [None])
+  payload, offsets = first.encode_many(messages, packed=True)
+  assert(len(offsets) == len(messages) + 1)
+  assert(first.decode_many(payload, offsets) == messages)
+  assert(first.decode_many(*first.encode_many([], packed=True)) == [])
+
+  # one call is one stats record, whatever it does inside, and decode bits
+  # are the code bits, without the padding after each parallel block
+  h = HuffmanTree.from_data("abracadabra", stats=HuffmanStats())
+  h.encode_indexed("abracadabra" * 50, interval=7)
+  assert(h.stats.calls['encode'] == 1 and h.stats.bits['encode'] == len(h._encode("abracadabra" * 50)))
+  h.decode_parallel(*h.encode_parallel("abracadabra" * 50, block_size=37, max_workers=2), max_workers=2)
+  assert(h.stats.calls['decode'] == 1 and h.stats.bits['decode'] * 2 == h.stats.bits['encode'])
+
+  # parallel blocks, more of them than workers, and the empty input
+  h = HuffmanTree.from_data("abracadabra")
+  for text in ("abracadabra" * 50, "a", ""):
+    payload, index = h.encode_parallel(text, block_size=37, max_workers=2)
+    assert(len(index) == -(-len(text) // 37))
+    assert(h.decode_parallel(payload, index, max_workers=2) == text)
+  # every call runs on the same pool; truncated payloads and blocks whose
+  # symbols don't reach their last byte are refused like decode_bytes would
+  pool = h._pool
+  payload, index = h.encode_parallel("abracadabra" * 50, block_size=37, max_workers=2)
+  assert(h._pool is pool)
+  assert(h.decode_parallel(payload[:-1], index, max_workers=2) is None)
+  assert(h.decode_parallel(payload, index[:1] + index[2:], max_workers=2) is None)
+  # close shuts the pool down and the tree stays usable; as a context
+  # manager it closes on exit
+  h.close()
+  assert(h._pool is None)
+  try:
+    pool.submit(int)
+    assert(False)
+  except RuntimeError:
+    pass
+  with h:
+    assert(h.decode_parallel(payload, index, max_workers=2) == "abracadabra" * 50)
+  assert(h._pool is None)
+
+  # from_data counts characters, bytes (from any buffer) or the items of
+  # other iterables, ints as characters like byte values; a lone symbol gets
+  # a filler so the tree has two leaves
+  assert(count_symbols(b"abca") == count_symbols("abca") == count_symbols(array('B', b"abca")))
+  assert(count_symbols(["the", "cat", "the"]) == {"the": 2, "cat": 1})
+  assert(count_symbols("ab", count_symbols(b"a")) == {"a": 2, "b": 1})
+  assert(count_symbols([97, 98, 99, 97]) == count_symbols(b"abca"))
+  if huffman.np is not None:
+    assert(count_symbols(huffman.np.frombuffer(b"abca", dtype=huffman.np.uint8)) == count_symbols(b"abca"))
+    assert(count_symbols(huffman.np.array([97, 98, 99, 97])) == count_symbols(b"abca"))
+  bad_values = [[1.5], [(1, 2)], [-1]]
+  if huffman.np is not None:
+    bad_values += [huffman.np.array([97, 10 ** 8]), huffman.np.array([-1, 97])]
+  for bad in bad_values:
+    try:
+      count_symbols(bad)
+      assert(False)
+    except ValueError:
+      pass
+  for ints in ([5, 5, 5], [1, 2, 1]):
+    h = HuffmanTree.from_data(ints)
+    assert(h.decode(h.encode([chr(i) for i in ints])) == "".join(chr(i) for i in ints))
+  h = HuffmanTree.from_data(["the", "cat", "the", "sat"])
+  assert(h.decode(h.encode(["cat", "the"])) == "catthe")
+  assert(HuffmanTree.from_data(b"zzz").code_lengths() == [("\x00", 1), ("z", 1)])
+  assert(HuffmanTree.from_data({"a": 3, "b": 1}).encode("ab") == HuffmanTree([("a", 3), ("b", 1)]).encode("ab"))
+
+  # adaptive coders, with input and bits split into random chunks
+  def chunks(text):
+    pieces = []
+    while text:
+      cut = rng.randint(1, 50)
+      pieces.append(text[:cut])
+      text = text[cut:]
+    return pieces
+  # every cut of "ab" but the one after "a" is refused, including the cut
+  # right after the NYT escape that announces "b" (bit 9)
+  bits = AdaptiveHuffmanEncoder().feed("ab")
+  for cut in range(1, len(bits)):
+    decoder = AdaptiveHuffmanDecoder()
+    decoded = decoder.feed(bits[:cut])
+    assert(decoder.flush() is None if cut != 8 else decoded == "a")
+  for symbol_bits, text in ((8, "mississippi river " * 40), (21, "".join(chr(rng.randint(0, 0x2000)) for _ in range(500)))):
+    encoder = AdaptiveHuffmanEncoder(symbol_bits)
+    bits = "".join([encoder.feed(piece) for piece in chunks(text)]) + encoder.flush()
+    decoder = AdaptiveHuffmanDecoder(symbol_bits)
+    assert("".join([decoder.feed(piece) for piece in chunks(bits)]) == text and decoder.flush() == "")
+    decoder = AdaptiveHuffmanDecoder(symbol_bits)
+    decoder.feed(bits[:-1])
+    assert(decoder.flush() is None)
+    # packed: the bits in bytes plus the padding trailer, which keeps the
+    # padding from being decoded as symbols
+    encoder = AdaptiveHuffmanEncoder(symbol_bits, packed=True)
+    packed = b"".join([encoder.feed(piece) for piece in chunks(text)]) + encoder.flush()
+    padding = -len(bits) % 8
+    assert(packed[:-1] == int(bits + "0" * padding, 2).to_bytes(len(packed) - 1, 'big') and packed[-1] == padding)
+    decoder = AdaptiveHuffmanDecoder(symbol_bits, packed=True)
+    decoded = "".join([decoder.feed(piece) for piece in chunks(packed)])
+    assert(decoded + decoder.flush() == text)
+  for text in ("", "a", "ab"):
+    encoder = AdaptiveHuffmanEncoder(packed=True)
+    packed = encoder.feed(text) + encoder.flush()
+    decoder = AdaptiveHuffmanDecoder(packed=True)
+    assert(decoder.feed(packed) + decoder.flush() == text)
+  # a refused chunk leaves the encoder as it was, in step with the decoder
+  encoder = AdaptiveHuffmanEncoder()
+  bits = encoder.feed("ab")
+  try:
+    encoder.feed("c\u0100")
+    assert(False)
+  except ValueError:
+    pass
+  bits += encoder.feed("cab") + encoder.flush()
+  decoder = AdaptiveHuffmanDecoder()
+  assert(decoder.feed(bits) + decoder.flush() == "abcab")
+  # flush starts both over with an empty tree, even after a failed stream
+  for packed_mode in (False, True):
+    encoder = AdaptiveHuffmanEncoder(packed=packed_mode)
+    decoder = AdaptiveHuffmanDecoder(packed=packed_mode)
+    first_stream = encoder.feed("abcab") + encoder.flush()
+    assert(decoder.feed(first_stream) + decoder.flush() == "abcab")
+    assert(encoder.feed("abcab") + encoder.flush() == first_stream)
+    if not packed_mode:
+      decoder.feed(first_stream[:-1])
+      assert(decoder.flush() is None)
+    second_stream = encoder.feed("cba") + encoder.flush()
+    assert(decoder.feed(second_stream) + decoder.flush() == "cba")
+
+  # command line round trips; a failed run leaves its output untouched
+  with tempfile.TemporaryDirectory() as tmp:
+    paths = [os.path.join(tmp, name) for name in ("input", "packed", "output")]
+    for data in (b"", b"z", b"zzzz", b"abracadabra" * 1000, bytes(range(256)) * 3):
+      with open(paths[0], 'wb') as out: out.write(data)
+      assert(huffman.main(["compress", paths[0], paths[1]]) == 0)
+      assert(huffman.main(["decompress", paths[1], paths[2]]) == 0)
+      with open(paths[2], 'rb') as result: assert(result.read() == data)
+    with contextlib.redirect_stderr(io.StringIO()):
+      assert(huffman.main(["compress", paths[0], paths[0]]) == 1)
+      assert(huffman.main(["decompress", paths[0], paths[2]]) == 1)
+    with open(paths[0], 'rb') as original, open(paths[2], 'rb') as kept:
+      assert(original.read() == kept.read() == data)
+    assert(sorted(os.listdir(tmp)) == ["input", "output", "packed"])
+
+  # compressing a 32 MB file stays within its mapped pages plus 32 MB more;
+  # the child measures itself so the pools above don't count
+  rss_check = """import resource, sys, huffman
+start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+assert(huffman.main(sys.argv[1:]) == 0)
+print((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start) // 1024)"""
+  if sys.platform.startswith('linux'):
+    with tempfile.TemporaryDirectory() as tmp:
+      paths = [os.path.join(tmp, name) for name in ("input", "packed")]
+      block = bytes(rng.choices(range(256), weights=range(256, 0, -1), k=1 << 20))
+      with open(paths[0], 'wb') as out:
+        for _ in range(32): out.write(block)
+      grown = subprocess.run([sys.executable, "-c", rss_check, "compress"] + paths, cwd=os.path.dirname(os.path.abspath(huffman.__file__)),
+                             check=True, capture_output=True, text=True).stdout
+      assert(int(grown) < 64)